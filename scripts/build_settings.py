@@ -0,0 +1,317 @@
+"""
+Xcode のビルド設定（$(VARIABLE) 参照と .xcconfig）を評価するモジュール
+
+xcodebuild -showBuildSettings を使わずに、ターゲット・ビルド構成ごとの
+設定値を Python だけで解決する。優先順位は低い方から
+組み込み値 → プロジェクトの .xcconfig → プロジェクトの設定
+→ ターゲットの .xcconfig → ターゲットの設定。
+"""
+import os
+import re
+from functools import lru_cache
+
+
+# .xcconfig の行（KEY = value / KEY[sdk=...] = value）
+XCCONFIG_SETTING_RE = re.compile(r'^\s*([A-Za-z_][A-Za-z0-9_]*)\s*(\[[^\]]*\])?\s*=\s*(.*?)\s*;?\s*$')
+XCCONFIG_INCLUDE_RE = re.compile(r'^\s*#include(\?)?\s*"([^"]+)"')
+
+# 変数名として扱う文字
+VARIABLE_NAME_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+# 組み込みのプラットフォーム設定（iOS 向け）
+PLATFORM_DEFAULTS = {
+    'PLATFORM_NAME': 'iphoneos',
+    'SDK_NAME': 'iphoneos',
+    'EFFECTIVE_PLATFORM_NAME': '-iphoneos',
+}
+
+# プロジェクト・ターゲットから決まる組み込みの設定（環境変数より優先）
+DERIVED_SETTING_NAMES = frozenset({
+    'PROJECT_NAME', 'PROJECT_FILE_PATH', 'SRCROOT', 'PROJECT_DIR', 'SOURCE_ROOT',
+    'CONFIGURATION', 'TARGET_NAME', 'PRODUCT_NAME',
+})
+
+
+# 解析中の .xcconfig のパス
+_xcconfig_in_progress = set()
+
+
+def _strip_comment(line):
+    """// 以降のコメントを除去（URL の :// は残す）"""
+    index = 0
+    while True:
+        index = line.find('//', index)
+        if index == -1:
+            return line
+        if index == 0 or line[index - 1] != ':':
+            return line[:index]
+        index += 2
+
+
+@lru_cache(maxsize=None)
+def parse_xcconfig(path):
+    """.xcconfig を解析（#include を展開）して設定の dict を返す
+    
+    条件付きの設定（KEY[sdk=...]）は iphoneos 向けのもののみ採用する。
+    同じファイルは一度だけ解析される。
+    """
+    settings = {}
+    # #include の循環を防ぐ
+    if path in _xcconfig_in_progress:
+        return settings
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+    except OSError:
+        return settings
+    
+    _xcconfig_in_progress.add(path)
+    
+    base_dir = os.path.dirname(path)
+    for line in lines:
+        include = XCCONFIG_INCLUDE_RE.match(line)
+        if include:
+            include_path = os.path.normpath(os.path.join(base_dir, include.group(2)))
+            settings.update(parse_xcconfig(include_path))
+            continue
+        
+        match = XCCONFIG_SETTING_RE.match(_strip_comment(line))
+        if not match:
+            continue
+        key, condition, value = match.groups()
+        if condition and 'iphoneos' not in condition and '*' not in condition:
+            continue
+        settings[key] = value
+    
+    _xcconfig_in_progress.discard(path)
+    return settings
+
+
+@lru_cache(maxsize=None)
+def xcconfig_dependencies(path):
+    """.xcconfig 自身と #include で読み込まれるファイルのパスを返す"""
+    files = [path]
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+    except OSError:
+        return tuple(files)
+    
+    base_dir = os.path.dirname(path)
+    for line in lines:
+        include = XCCONFIG_INCLUDE_RE.match(line)
+        if include:
+            include_path = os.path.normpath(os.path.join(base_dir, include.group(2)))
+            if include_path not in files and include_path not in _xcconfig_in_progress:
+                _xcconfig_in_progress.add(path)
+                try:
+                    files.extend(f for f in xcconfig_dependencies(include_path) if f not in files)
+                finally:
+                    _xcconfig_in_progress.discard(path)
+    return tuple(files)
+
+
+def _apply_operator(value, operator):
+    """$(VAR:operator) の演算子を適用"""
+    if operator.startswith('default='):
+        return value or operator[len('default='):]
+    if operator == 'lower':
+        return value.lower()
+    if operator == 'upper':
+        return value.upper()
+    if operator == 'rfc1034identifier':
+        return re.sub(r'[^A-Za-z0-9.-]', '-', value)
+    if operator in ('c99extidentifier', 'identifier'):
+        return re.sub(r'[^A-Za-z0-9_]', '_', value)
+    if operator == 'base':
+        return os.path.splitext(os.path.basename(value))[0]
+    if operator == 'suffix':
+        return os.path.splitext(value)[1]
+    if operator == 'file':
+        return os.path.basename(value)
+    if operator == 'dir':
+        return os.path.dirname(value)
+    if operator == 'standardizepath':
+        return os.path.normpath(value)
+    return value
+
+
+class UnresolvedVariable(Exception):
+    """定義されていない変数を参照している"""
+
+
+class BuildSettingsResolver:
+    """ターゲット・ビルド構成ごとにビルド設定を評価する（結果はメモ化）"""
+    
+    def __init__(self, index, xcodeproj_path, environ=None):
+        self.index = index
+        self.xcodeproj_path = str(xcodeproj_path)
+        self.source_root = os.path.dirname(os.path.abspath(self.xcodeproj_path))
+        self.environ = dict(os.environ if environ is None else environ)
+        self._layers = {}
+        self._memo = {}
+        # 評価に使用した .xcconfig（キャッシュの無効化判定用）
+        self.xcconfig_files = set()
+        # 環境変数から参照した（または参照しようとして未定義だった）変数（キャッシュの無効化判定用）
+        self.referenced_environ = {}
+    
+    def _xcconfig_settings(self, build_configuration):
+        """XCBuildConfiguration の baseConfigurationReference が指す .xcconfig の設定"""
+        file_ref_id = build_configuration.get('baseConfigurationReference')
+        if not file_ref_id:
+            return {}
+        path = self.index.file_reference_path(file_ref_id, self.source_root)
+        if not path:
+            return {}
+        self.xcconfig_files.update(p for p in xcconfig_dependencies(path) if os.path.exists(p))
+        return dict(parse_xcconfig(path))
+    
+    def layers(self, target, configuration):
+        """優先順位の低い順に並べた設定のレイヤーを返す"""
+        key = (target, configuration)
+        if key in self._layers:
+            return self._layers[key]
+        
+        project_name = os.path.splitext(os.path.basename(self.xcodeproj_path))[0]
+        builtins = dict(self.environ)
+        builtins.update(PLATFORM_DEFAULTS)
+        builtins.update({
+            'PROJECT_NAME': project_name,
+            'PROJECT_FILE_PATH': self.xcodeproj_path,
+            'SRCROOT': self.source_root,
+            'PROJECT_DIR': self.source_root,
+            'SOURCE_ROOT': self.source_root,
+            'CONFIGURATION': configuration,
+        })
+        if target:
+            builtins['TARGET_NAME'] = target
+            builtins['PRODUCT_NAME'] = target
+        
+        layers = [builtins]
+        project_configuration = self.index.project_configurations.get(configuration)
+        if project_configuration:
+            layers.append(self._xcconfig_settings(project_configuration))
+            layers.append(project_configuration.get('buildSettings', {}))
+        
+        target_configuration = self.index.targets.get(target, {}).get(configuration)
+        if target_configuration:
+            layers.append(self._xcconfig_settings(target_configuration))
+            layers.append(target_configuration.get('buildSettings', {}))
+        
+        self._layers[key] = layers
+        return layers
+    
+    def resolve(self, target, configuration, name):
+        """設定値を評価して返す（未定義の変数を参照している場合は None）"""
+        try:
+            return self._evaluate(target, configuration, name, None, set())
+        except UnresolvedVariable:
+            return None
+    
+    def expand(self, target, configuration, value):
+        """任意の文字列中の変数参照を展開（未定義の変数を参照している場合は None）"""
+        try:
+            return self._expand(target, configuration, value, None, 0, set())
+        except UnresolvedVariable:
+            return None
+    
+    def _evaluate(self, target, configuration, name, below, in_progress):
+        """below より下のレイヤーで定義された name の値を評価"""
+        layers = self.layers(target, configuration)
+        top = len(layers) if below is None else below
+        memo_key = (target, configuration, name, top)
+        if memo_key in self._memo:
+            return self._memo[memo_key]
+        
+        for level in range(top - 1, -1, -1):
+            raw = layers[level].get(name)
+            if level == 0:
+                self._note_environ(name)
+            if raw is None:
+                continue
+            if isinstance(raw, list):
+                raw = ' '.join(raw)
+            
+            # 循環参照は未定義として扱う
+            if memo_key in in_progress:
+                raise UnresolvedVariable(name)
+            in_progress.add(memo_key)
+            try:
+                value = self._expand(target, configuration, raw, name, level, in_progress)
+            finally:
+                in_progress.discard(memo_key)
+            break
+        else:
+            if below is not None:
+                # $(inherited) で下位レイヤーに定義がない場合は空文字
+                value = ''
+            else:
+                raise UnresolvedVariable(name)
+        
+        self._memo[memo_key] = value
+        return value
+    
+    def _note_environ(self, name):
+        """組み込みのレイヤーまで探索した変数のうち、環境変数で決まるものを記録"""
+        if name in PLATFORM_DEFAULTS or name in DERIVED_SETTING_NAMES:
+            return
+        self.referenced_environ[name] = self.environ.get(name)
+    
+    def _expand(self, target, configuration, raw, current_name, level, in_progress):
+        """文字列中の $(VAR) / ${VAR} / $VAR を展開"""
+        result = []
+        i = 0
+        while i < len(raw):
+            char = raw[i]
+            if char != '$' or i + 1 >= len(raw):
+                result.append(char)
+                i += 1
+                continue
+            
+            opener = raw[i + 1]
+            if opener in '({':
+                closer = ')' if opener == '(' else '}'
+                end = self._find_closing(raw, i + 2, opener, closer)
+                if end == -1:
+                    result.append(raw[i:])
+                    break
+                content = self._expand(target, configuration, raw[i + 2:end], current_name, level, in_progress)
+                i = end + 1
+            else:
+                match = VARIABLE_NAME_RE.match(raw, i + 1)
+                if not match:
+                    result.append(char)
+                    i += 1
+                    continue
+                content = match.group()
+                i = match.end()
+            
+            variable, *operators = content.split(':')
+            if variable == 'inherited' or (variable == current_name and not operators and level > 0):
+                value = self._evaluate(target, configuration, current_name, level, in_progress)
+            elif any(op.startswith('default=') for op in operators):
+                try:
+                    value = self._evaluate(target, configuration, variable, None, in_progress)
+                except UnresolvedVariable:
+                    value = ''
+            else:
+                value = self._evaluate(target, configuration, variable, None, in_progress)
+            
+            for operator in operators:
+                value = _apply_operator(value, operator)
+            result.append(value)
+        
+        return ''.join(result)
+    
+    @staticmethod
+    def _find_closing(text, start, opener, closer):
+        """ネストを考慮して対応する閉じ括弧の位置を返す"""
+        depth = 1
+        for index in range(start, len(text)):
+            if text[index] == opener:
+                depth += 1
+            elif text[index] == closer:
+                depth -= 1
+                if depth == 0:
+                    return index
+        return -1
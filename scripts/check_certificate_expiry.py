@@ -6,25 +6,322 @@ import os
 import sys
 import json
 import requests
-from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from datetime import datetime, timedelta, timezone
 import jwt
 import time
+import base64
+import hashlib
+import tempfile
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from cryptography import x509
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.serialization import pkcs12
+
+
+# トークンの有効期間（Apple の上限は20分）
+TOKEN_LIFETIME = 20 * 60
+# 有効期限の何秒前にトークンを再生成するか
+TOKEN_REFRESH_MARGIN = 60
+
+# HTTP 接続プールのサイズとタイムアウト（秒）のデフォルト値
+DEFAULT_POOL_SIZE = int(os.environ.get('APP_STORE_CONNECT_POOL_SIZE', '10'))
+DEFAULT_CONNECT_TIMEOUT = float(os.environ.get('APP_STORE_CONNECT_CONNECT_TIMEOUT', '10'))
+DEFAULT_READ_TIMEOUT = float(os.environ.get('APP_STORE_CONNECT_READ_TIMEOUT', '60'))
+
+# 一覧取得時の1ページあたりの件数（API の上限は200）
+PAGE_LIMIT = 200
+
+# 期限チェック対象の証明書タイプ
+DISTRIBUTION_CERTIFICATE_TYPE = 'IOS_DISTRIBUTION'
+# 再作成するプロビジョニングプロファイルのタイプ
+APP_STORE_PROFILE_TYPE = 'IOS_APP_STORE'
+# 期限チェックで取得する属性（certificateContent を除外して転送量を削減）
+CERTIFICATE_FIELDS = 'name,certificateType,expirationDate'
+# 証明書→Bundle ID インデックス作成時に取得するフィールド
+INDEX_PROFILE_FIELDS = 'bundleId,certificates'
+INDEX_BUNDLE_ID_FIELDS = 'identifier'
+INDEX_CERTIFICATE_FIELDS = 'name'
+# プロファイル1件あたりに含める証明書リレーションの上限（API の上限は50）
+INCLUDED_CERTIFICATES_LIMIT = 50
+# プロファイル取得の同時リクエスト数の上限（1 の場合は一括取得のみ）
+DEFAULT_MAX_CONCURRENCY = int(os.environ.get('APP_STORE_CONNECT_MAX_CONCURRENCY', '1'))
+
+# 429/5xx・接続エラー時の最大リトライ回数とバックオフの基準秒数
+MAX_RETRIES = int(os.environ.get('APP_STORE_CONNECT_MAX_RETRIES', '3'))
+RETRY_BACKOFF_BASE = float(os.environ.get('APP_STORE_CONNECT_RETRY_BACKOFF', '1'))
+RETRY_BACKOFF_MAX = 60
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+# 尊重する Retry-After の上限（秒）
+RETRY_AFTER_MAX = float(os.environ.get('APP_STORE_CONNECT_RETRY_AFTER_MAX', '120'))
+# Apple の1時間あたりのリクエスト上限（X-Rate-Limit ヘッダーで上書きされる）
+DEFAULT_HOURLY_LIMIT = 3600
+# クォータの集計期間（秒）
+RATE_LIMIT_WINDOW = 3600
+# 残りクォータが上限のこの割合を下回ったら、残り時間に合わせて送信間隔を空ける
+LOW_QUOTA_RATIO = float(os.environ.get('APP_STORE_CONNECT_LOW_QUOTA_RATIO', '0.1'))
+
+
+class RateLimiter:
+    """X-Rate-Limit ヘッダーの残量に応じてリクエストの送信間隔を調整する
+    
+    残りクォータに余裕がある間は待機せずに送信し、上限の LOW_QUOTA_RATIO を
+    下回った場合のみ、残りのクォータを集計期間の残り時間に均等に割り当てる。
+    """
+    
+    def __init__(self, hourly_limit=DEFAULT_HOURLY_LIMIT, low_quota_ratio=LOW_QUOTA_RATIO):
+        self.hourly_limit = hourly_limit
+        self.low_quota_ratio = low_quota_ratio
+        self._window_started_at = time.monotonic()
+        self._next_allowed_at = 0.0
+        # 最後のレスポンス以降に送信した分を差し引いた残りクォータの見積もり
+        self._remaining_estimate = None
+        self._lock = threading.Lock()
+        
+        # 実行ごとの使用状況
+        self.requests = 0
+        self.throttled = 0
+        self.retries = 0
+        self.quota_remaining = None
+        self._initial_remaining = None
+    
+    def acquire(self):
+        """リクエストの送信枠を取得（残りクォータが少ない場合のみ待機）"""
+        with self._lock:
+            self.requests += 1
+            remaining = self._remaining_estimate
+            if remaining is not None:
+                self._remaining_estimate = remaining - 1
+            if remaining is None or remaining > self.hourly_limit * self.low_quota_ratio:
+                return
+            
+            now = time.monotonic()
+            time_left = max(RATE_LIMIT_WINDOW - (now - self._window_started_at), 1)
+            interval = time_left / max(remaining, 1)
+            start_at = max(now, self._next_allowed_at)
+            self._next_allowed_at = start_at + interval
+            wait = start_at - now
+        if wait > 0:
+            time.sleep(wait)
+    
+    def update_from_headers(self, headers):
+        """X-Rate-Limit ヘッダー（例: user-hour-lim:3600;user-hour-rem:3598;）を反映"""
+        value = headers.get('X-Rate-Limit')
+        if not value:
+            return
+        
+        fields = {}
+        for item in value.split(';'):
+            name, _, number = item.partition(':')
+            if number.strip().isdigit():
+                fields[name.strip()] = int(number)
+        
+        with self._lock:
+            if 'user-hour-lim' in fields:
+                self.hourly_limit = max(fields['user-hour-lim'], 1)
+            if 'user-hour-rem' in fields:
+                remaining = fields['user-hour-rem']
+                self.quota_remaining = remaining
+                if self._initial_remaining is None:
+                    # 最初のレスポンスの残量は、そのリクエスト自身を消費した後の値
+                    self._initial_remaining = remaining + 1
+                self._remaining_estimate = remaining
+    
+    def backoff(self, attempt, retry_after=None, throttled=False):
+        """リトライ前に待機（Retry-After があれば優先）"""
+        with self._lock:
+            self.retries += 1
+            if throttled:
+                self.throttled += 1
+        if retry_after is not None:
+            wait = min(retry_after, RETRY_AFTER_MAX)
+        else:
+            wait = min(RETRY_BACKOFF_BASE * (2 ** attempt), RETRY_BACKOFF_MAX)
+        time.sleep(wait)
+    
+    def stats(self):
+        """今回の実行で使用したクォータなどの集計値を返す"""
+        with self._lock:
+            quota_used = None
+            if self._initial_remaining is not None and self.quota_remaining is not None:
+                quota_used = self._initial_remaining - self.quota_remaining
+            return {
+                'requests': self.requests,
+                'throttled': self.throttled,
+                'retries': self.retries,
+                'quota_limit': self.hourly_limit,
+                'quota_remaining': self.quota_remaining,
+                'quota_used': quota_used,
+            }
+
+
+# レスポンスキャッシュの設定（CACHE_DIR が未設定の場合は無効）
+RESPONSE_CACHE_DIR = os.environ.get('APP_STORE_CONNECT_CACHE_DIR')
+RESPONSE_CACHE_TTL = int(os.environ.get('APP_STORE_CONNECT_CACHE_TTL', str(24 * 60 * 60)))
+# リレーション（include）を含むレスポンスの有効期間（外部での失効・再作成を反映しやすくする）
+RESPONSE_CACHE_RELATIONSHIP_TTL = int(os.environ.get('APP_STORE_CONNECT_CACHE_RELATIONSHIP_TTL', str(60 * 60)))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('APP_STORE_CONNECT_CACHE_MAX_BYTES', str(50 * 1024 * 1024)))
+RESPONSE_CACHE_BYPASS = os.environ.get('APP_STORE_CONNECT_CACHE_BYPASS', 'false').lower() == 'true'
+
+
+class ResponseCache:
+    """読み取り専用エンドポイントのレスポンスをディスクに保存するキャッシュ"""
+    
+    def __init__(self, cache_dir, ttl=RESPONSE_CACHE_TTL, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+    
+    @staticmethod
+    def make_key(namespace, url, params):
+        """エンドポイントとクエリパラメータからキャッシュキーを作成"""
+        normalized = json.dumps(
+            [namespace, url, sorted((params or {}).items())],
+            sort_keys=True, default=str
+        )
+        return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+    
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+    
+    def get(self, key, ttl=None):
+        """有効期限内のレスポンスを返す（なければ None）。ttl を指定した場合は既定値より優先"""
+        ttl = self.ttl if ttl is None else ttl
+        path = self._path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        
+        if time.time() - entry.get('stored_at', 0) > ttl:
+            # 期限切れのエントリは削除
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            with self._lock:
+                self.misses += 1
+            return None
+        
+        with self._lock:
+            self.hits += 1
+        return entry.get('body')
+    
+    def set(self, key, body):
+        """レスポンスを保存し、サイズ上限を超えた分は古い順に削除"""
+        entry = {'stored_at': time.time(), 'body': body}
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, self._path(key))
+        self._evict()
+    
+    def _evict(self):
+        """合計サイズが上限を超えている場合、更新日時の古いエントリから削除"""
+        with self._lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.cache_dir):
+                if entry.is_file() and entry.name.endswith('.json'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+            
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+    
+    def clear(self):
+        """キャッシュをすべて削除（書き込み系の操作後に使用）"""
+        with self._lock:
+            for entry in os.scandir(self.cache_dir):
+                if entry.is_file() and entry.name.endswith('.json'):
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+
+
+def parse_retry_after(value):
+    """Retry-After ヘッダーを秒数に変換（解釈できない場合は None）"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        return None
 
 
 class AppStoreConnectAPI:
-    def __init__(self, key_id, issuer_id, key_path):
+    def __init__(self, key_id, issuer_id, key_path=None, pool_size=DEFAULT_POOL_SIZE,
+                 timeout=(DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT),
+                 cache_dir=RESPONSE_CACHE_DIR, bypass_cache=RESPONSE_CACHE_BYPASS,
+                 private_key=None):
         self.key_id = key_id
         self.issuer_id = issuer_id
         self.key_path = key_path
+        # 秘密鍵の内容（指定された場合は key_path より優先）
+        self._private_key_pem = private_key
         self.base_url = "https://api.appstoreconnect.apple.com/v1"
+        self.timeout = timeout
+        
+        # Keep-Alive で接続を再利用するセッション（TLSハンドシェイクを1回に抑える）
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Connection': 'keep-alive'})
+        
+        # クライアント全体で共有するレートリミッター
+        self.rate_limiter = RateLimiter()
+        
+        # 読み取り専用エンドポイントのディスクキャッシュ（オプション）
+        self.cache = ResponseCache(cache_dir) if cache_dir else None
+        self.bypass_cache = bypass_cache
+        
+        # 秘密鍵とトークンのキャッシュ（複数スレッドから共有される）
+        self._private_key = None
+        self._token = None
+        self._token_expires_at = 0
+        self._token_lock = threading.Lock()
+    
+    def _load_private_key(self):
+        """秘密鍵を読み込んでパース（クライアントごとに1回のみ）"""
+        if self._private_key is None:
+            if self._private_key_pem:
+                key_data = self._private_key_pem.encode('utf-8')
+            else:
+                with open(self.key_path, 'rb') as f:
+                    key_data = f.read()
+            self._private_key = serialization.load_pem_private_key(key_data, password=None)
+        return self._private_key
+    
+    def _get_token(self):
+        """キャッシュ済みのトークンを返す（期限が近い場合は再生成）"""
+        with self._token_lock:
+            if self._token is None or time.time() >= self._token_expires_at - TOKEN_REFRESH_MARGIN:
+                self._token, self._token_expires_at = self._generate_token()
+            return self._token
         
     def _generate_token(self):
         """JWT トークンを生成"""
-        with open(self.key_path, 'r') as f:
-            private_key = f.read()
+        private_key = self._load_private_key()
         
         # トークンの有効期限（最大20分）
-        expiration_time = int(time.time()) + (20 * 60)
+        expiration_time = int(time.time()) + TOKEN_LIFETIME
         
         # JWT ペイロード
         payload = {
@@ -41,35 +338,317 @@ class AppStoreConnectAPI:
             headers={'kid': self.key_id}
         )
         
-        return token
+        return token, expiration_time
     
-    def _make_request(self, endpoint, method='GET', params=None):
+    def _make_request(self, endpoint, method='GET', params=None, data=None):
         """API リクエストを実行"""
-        url = f"{self.base_url}{endpoint}"
-        headers = {
-            'Authorization': f'Bearer {self._generate_token()}',
-            'Content-Type': 'application/json'
-        }
+        # links.next などの絶対URLはそのまま使用
+        url = endpoint if endpoint.startswith('https://') else f"{self.base_url}{endpoint}"
+        
+        # GET はキャッシュを参照し、書き込み系の操作はキャッシュを無効化
+        cache_key = None
+        if self.cache:
+            if method == 'GET':
+                cache_key = ResponseCache.make_key(f"{self.issuer_id}:{self.key_id}", url, params)
+                if not self.bypass_cache:
+                    # links.next の URL にはクエリパラメータが含まれる
+                    relationship = 'include' in (params or {}) or 'include=' in url
+                    cached = self.cache.get(
+                        cache_key, ttl=RESPONSE_CACHE_RELATIONSHIP_TTL if relationship else None
+                    )
+                    if cached is not None:
+                        return cached
+        
+        for attempt in range(MAX_RETRIES + 1):
+            self.rate_limiter.acquire()
+            # Retry-After の待機中に期限切れにならないよう、送信のたびにトークンを取得
+            headers = {
+                'Authorization': f'Bearer {self._get_token()}',
+                'Content-Type': 'application/json'
+            }
+            try:
+                response = self.session.request(
+                    method, url, headers=headers, params=params, json=data, timeout=self.timeout
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # 書き込み系は送信済みの可能性があるため、GET のみリトライ
+                if method != 'GET' or attempt == MAX_RETRIES:
+                    raise
+                print(f"警告: API への接続に失敗しました。リトライします "
+                      f"({attempt + 1}/{MAX_RETRIES}): {e}", file=sys.stderr)
+                self.rate_limiter.backoff(attempt)
+                continue
+            self.rate_limiter.update_from_headers(response.headers)
+            
+            # 書き込み系は処理済みの可能性があるため、429 以外ではリトライしない
+            retryable = response.status_code in RETRYABLE_STATUS_CODES and (
+                method == 'GET' or response.status_code == 429
+            )
+            if not retryable or attempt == MAX_RETRIES:
+                break
+            
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            print(f"警告: API が {response.status_code} を返しました。リトライします "
+                  f"({attempt + 1}/{MAX_RETRIES})", file=sys.stderr)
+            self.rate_limiter.backoff(attempt, retry_after, throttled=response.status_code == 429)
+        
+        # 書き込み系はエラー（無効化済みの証明書への 404 など）でも状態が変わっている
+        # 可能性があるため、結果に関わらずキャッシュを無効化
+        if self.cache and method != 'GET':
+            self.cache.clear()
         
-        response = requests.request(method, url, headers=headers, params=params)
         response.raise_for_status()
         
-        return response.json()
+        # DELETE などはレスポンスボディが空
+        body = response.json() if response.content else None
+        if cache_key:
+            self.cache.set(cache_key, body)
+        
+        return body
+    
+    def close(self):
+        """HTTP セッションを閉じる"""
+        self.session.close()
+    
+    def iter_pages(self, endpoint, params=None):
+        """一覧系エンドポイントのページを links.next をたどりながら順に返す"""
+        params = dict(params or {})
+        params.setdefault('limit', PAGE_LIMIT)
+        
+        next_url = endpoint
+        while next_url:
+            page = self._make_request(next_url, params=params)
+            yield page
+            # next のURLにはクエリパラメータが含まれている
+            next_url = page.get('links', {}).get('next')
+            params = None
+    
+    def iter_resources(self, endpoint, params=None):
+        """一覧系エンドポイントのリソースを1件ずつ返す（必要なページだけ取得）"""
+        for page in self.iter_pages(endpoint, params=params):
+            for resource in page.get('data', []):
+                yield resource
+    
+    def _collect_pages(self, endpoint, params=None):
+        """全ページを取得して1つのレスポンスにまとめる"""
+        data = []
+        included = []
+        for page in self.iter_pages(endpoint, params=params):
+            data.extend(page.get('data', []))
+            included.extend(page.get('included', []))
+        return {'data': data, 'included': included}
     
-    def get_certificates(self):
-        """証明書一覧を取得"""
-        return self._make_request('/certificates')
+    def _certificate_params(self, certificate_type=None, fields=None):
+        """証明書一覧のクエリパラメータを組み立てる"""
+        params = {}
+        if certificate_type:
+            params['filter[certificateType]'] = certificate_type
+        if fields:
+            params['fields[certificates]'] = fields
+        return params
+    
+    def iter_certificates(self, certificate_type=None, fields=None):
+        """証明書を1件ずつ返す"""
+        return self.iter_resources(
+            '/certificates', params=self._certificate_params(certificate_type, fields)
+        )
+    
+    def get_certificates(self, certificate_type=None, fields=None):
+        """証明書一覧を取得（全ページ）"""
+        return self._collect_pages(
+            '/certificates', params=self._certificate_params(certificate_type, fields)
+        )
     
     def get_certificate_details(self, certificate_id):
         """証明書の詳細情報を取得"""
         return self._make_request(f'/certificates/{certificate_id}')
     
-    def get_profiles(self, certificate_id=None):
-        """プロビジョニングプロファイル一覧を取得"""
+    def create_certificate(self, csr_content, certificate_type=DISTRIBUTION_CERTIFICATE_TYPE):
+        """CSR から証明書を作成"""
+        return self._make_request('/certificates', method='POST', data={
+            'data': {
+                'type': 'certificates',
+                'attributes': {
+                    'certificateType': certificate_type,
+                    'csrContent': csr_content
+                }
+            }
+        })
+
+    def revoke_certificate(self, certificate_id):
+        """証明書を無効化（キャッシュ済みのレスポンスも破棄される）"""
+        return self._make_request(f'/certificates/{certificate_id}', method='DELETE')
+
+    def _profile_params(self, certificate_id=None, fields=None):
+        """プロファイル一覧のクエリパラメータを組み立てる"""
         params = {}
         if certificate_id:
             params['filter[certificates]'] = certificate_id
-        return self._make_request('/profiles', params=params)
+        if fields:
+            params['fields[profiles]'] = fields
+        return params
+    
+    def iter_profiles(self, certificate_id=None, fields=None):
+        """プロビジョニングプロファイルを1件ずつ返す"""
+        return self.iter_resources(
+            '/profiles', params=self._profile_params(certificate_id, fields)
+        )
+    
+    def get_profiles(self, certificate_id=None, fields=None):
+        """プロビジョニングプロファイル一覧を取得（全ページ）"""
+        return self._collect_pages(
+            '/profiles', params=self._profile_params(certificate_id, fields)
+        )
+    
+    def get_bundle_id_resources(self, identifiers, platform='IOS'):
+        """Bundle ID（identifier）→ bundleIds リソースID の対応を一括取得"""
+        params = {
+            'filter[identifier]': ','.join(identifiers),
+            'filter[platform]': platform,
+            'fields[bundleIds]': 'identifier',
+        }
+        resources = {}
+        for resource in self.iter_resources('/bundleIds', params=params):
+            identifier = resource.get('attributes', {}).get('identifier')
+            # filter[identifier] は前方一致も含むため完全一致のみ採用
+            if identifier in identifiers:
+                resources[identifier] = resource['id']
+        return resources
+    
+    @staticmethod
+    def _iter_profiles_with_bundle_id(page):
+        """プロファイル一覧の1ページから（プロファイル, Bundle ID）を返す（Bundle ID が不明なものは除外）"""
+        # included はそのページの data に対応する
+        identifiers = {
+            resource['id']: resource.get('attributes', {}).get('identifier')
+            for resource in page.get('included', [])
+            if resource.get('type') == 'bundleIds'
+        }
+        for profile in page.get('data', []):
+            bundle_id_ref = (profile.get('relationships', {}).get('bundleId', {}).get('data') or {}).get('id')
+            identifier = identifiers.get(bundle_id_ref)
+            if identifier:
+                yield profile, identifier
+    
+    @staticmethod
+    def _profile_certificate_ids(profile):
+        """プロファイルが参照する証明書IDの一覧"""
+        return [
+            cert_ref['id']
+            for cert_ref in profile.get('relationships', {}).get('certificates', {}).get('data') or []
+        ]
+    
+    def get_profile_certificates_by_bundle_id(self, profile_type=APP_STORE_PROFILE_TYPE):
+        """指定タイプのプロファイルを一括取得し、Bundle ID → {プロファイルID: 証明書IDの一覧} を返す"""
+        params = self._index_params()
+        params['filter[profileType]'] = profile_type
+        profiles = {}
+        for page in self.iter_pages('/profiles', params=params):
+            for profile, identifier in self._iter_profiles_with_bundle_id(page):
+                profiles.setdefault(identifier, {})[profile['id']] = self._profile_certificate_ids(profile)
+        return profiles
+    
+    def get_profile_content(self, profile_id):
+        """プロビジョニングプロファイルの内容（profileContent をデコードしたバイト列）を取得"""
+        response = self._make_request(
+            f'/profiles/{profile_id}', params={'fields[profiles]': 'profileContent'}
+        )
+        return base64.b64decode(response['data']['attributes']['profileContent'])
+    
+    def delete_profile(self, profile_id):
+        """プロビジョニングプロファイルを削除"""
+        return self._make_request(f'/profiles/{profile_id}', method='DELETE')
+    
+    def create_profile(self, name, bundle_id_resource_id, certificate_ids,
+                       profile_type=APP_STORE_PROFILE_TYPE):
+        """プロビジョニングプロファイルを作成（レスポンスに profileContent を含む）"""
+        return self._make_request('/profiles', method='POST', data={
+            'data': {
+                'type': 'profiles',
+                'attributes': {
+                    'name': name,
+                    'profileType': profile_type
+                },
+                'relationships': {
+                    'bundleId': {
+                        'data': {'type': 'bundleIds', 'id': bundle_id_resource_id}
+                    },
+                    'certificates': {
+                        'data': [{'type': 'certificates', 'id': cert_id} for cert_id in certificate_ids]
+                    }
+                }
+            }
+        })
+    
+    def _index_params(self, certificate_ids=None):
+        """証明書ID→Bundle ID インデックス用のプロファイル一覧のクエリパラメータ"""
+        params = {
+            'include': 'bundleId,certificates',
+            'fields[profiles]': INDEX_PROFILE_FIELDS,
+            'fields[bundleIds]': INDEX_BUNDLE_ID_FIELDS,
+            'fields[certificates]': INDEX_CERTIFICATE_FIELDS,
+            'limit[certificates]': INCLUDED_CERTIFICATES_LIMIT,
+        }
+        if certificate_ids:
+            params['filter[certificates]'] = ','.join(certificate_ids)
+        return params
+    
+    @classmethod
+    def _build_certificate_bundle_id_index(cls, pages):
+        """プロファイル一覧のページから証明書ID→Bundle ID のインデックスを作成"""
+        index = {}
+        for page in pages:
+            for profile, identifier in cls._iter_profiles_with_bundle_id(page):
+                for cert_id in cls._profile_certificate_ids(profile):
+                    cert_bundle_ids = index.setdefault(cert_id, [])
+                    if identifier not in cert_bundle_ids:
+                        cert_bundle_ids.append(identifier)
+        
+        return index
+    
+    def _fetch_certificate_bundle_id_index(self, certificate_ids=None):
+        """プロファイルをページ単位で取得して証明書ID→Bundle ID のインデックスを作成"""
+        return self._build_certificate_bundle_id_index(
+            self.iter_pages('/profiles', params=self._index_params(certificate_ids))
+        )
+    
+    def get_certificate_bundle_id_index(self, certificate_ids=None, max_concurrency=1):
+        """プロファイル一覧を取得し、証明書ID→Bundle ID のインデックスを作成
+        
+        まず一括で取得し、残りのページ数がワーカー数を超える場合のみ
+        証明書ごとの取得に切り替えて並行実行する（トークンと接続プールは
+        クライアントで共有）。それ以外は一括取得のページをそのまま使う。
+        Bundle ID はプロファイルの取得順に並び、重複は除外される。
+        """
+        if not certificate_ids or max_concurrency <= 1 or len(certificate_ids) == 1:
+            return self._fetch_certificate_bundle_id_index(certificate_ids)
+        
+        pages = self.iter_pages('/profiles', params=self._index_params(certificate_ids))
+        first_page = next(pages, None)
+        if first_page is None:
+            return {}
+        
+        # 一括取得のページ数（meta.paging.total がない場合は分割しない）
+        paging = first_page.get('meta', {}).get('paging', {})
+        total = paging.get('total') or 0
+        page_count = -(-total // (paging.get('limit') or PAGE_LIMIT))
+        if not first_page.get('links', {}).get('next') or page_count <= max_concurrency:
+            return self._build_certificate_bundle_id_index(itertools.chain([first_page], pages))
+        
+        with ThreadPoolExecutor(max_workers=min(max_concurrency, len(certificate_ids))) as executor:
+            # map は入力順に結果を返すため、マージ結果は実行順に依存しない
+            partial_indexes = executor.map(
+                lambda cert_id: self._fetch_certificate_bundle_id_index([cert_id]),
+                certificate_ids
+            )
+            
+            index = {}
+            for partial_index in partial_indexes:
+                for cert_id, cert_bundle_ids in partial_index.items():
+                    merged = index.setdefault(cert_id, [])
+                    merged.extend(b for b in cert_bundle_ids if b not in merged)
+        
+        return index
 
 
 def get_bundle_ids_from_output():
@@ -87,44 +666,38 @@ def get_bundle_ids_from_output():
     return None
 
 
-def check_certificate_expiry_for_bundle_ids(api, bundle_ids, days_threshold=30):
+def check_certificate_expiry_for_bundle_ids(api, bundle_ids, days_threshold=30,
+                                            max_concurrency=DEFAULT_MAX_CONCURRENCY):
     """特定のBundle IDに関連する証明書の有効期限をチェック"""
     print("証明書一覧を取得しています...")
     print(f"対象Bundle ID: {', '.join(bundle_ids)}")
     
     try:
-        # すべての証明書を取得
-        response = api.get_certificates()
-        certificates = response.get('data', [])
-        
-        if not certificates:
-            print("警告: 証明書が見つかりません")
-            return None, True
-        
-        # Distribution証明書をフィルタリング
-        distribution_certs = [
-            cert for cert in certificates 
-            if cert['attributes']['certificateType'] == 'IOS_DISTRIBUTION'
-        ]
+        # Distribution証明書を取得（フィルタと取得属性の絞り込みはサーバー側で実施）
+        distribution_certs = list(api.iter_certificates(
+            certificate_type=DISTRIBUTION_CERTIFICATE_TYPE,
+            fields=CERTIFICATE_FIELDS
+        ))
         
         if not distribution_certs:
             print("警告: Distribution証明書が見つかりません")
             return None, True
         
-        # 各証明書に関連するプロファイルを確認してBundle IDと照合
+        # プロファイルを一括取得して証明書→Bundle ID のインデックスを作成
+        print("プロファイル一覧を取得しています...")
+        cert_bundle_id_index = api.get_certificate_bundle_id_index(
+            certificate_ids=[cert['id'] for cert in distribution_certs],
+            max_concurrency=max_concurrency
+        )
+        
+        # 各証明書に関連するBundle IDを照合
         matching_certs = []
         
         for cert in distribution_certs:
             cert_id = cert['id']
             print(f"\n証明書 {cert_id} のプロファイルを確認中...")
             
-            # この証明書に関連するプロファイルを取得
-            profiles_response = api.get_profiles(certificate_id=cert_id)
-            profiles = profiles_response.get('data', [])
-            
-            # プロファイルのBundle IDを確認
-            for profile in profiles:
-                profile_bundle_id = profile['attributes'].get('bundleId', {}).get('identifier')
+            for profile_bundle_id in cert_bundle_id_index.get(cert_id, []):
                 if profile_bundle_id in bundle_ids:
                     print(f"  ✓ マッチ: {profile_bundle_id}")
                     matching_certs.append({
@@ -175,12 +748,310 @@ def check_certificate_expiry_for_bundle_ids(api, bundle_ids, days_threshold=30):
         return None, True
 
 
+def load_fleet_targets(base_bundle_ids):
+    """config/environments.json の全環境と追加チームからチェック対象を作成
+    
+    各環境の Bundle ID は、エントリの bundle_ids またはサフィックスなしの
+    base_bundle_ids に環境のサフィックスを付与したものを使用する。
+    追加チームは "teams" に name / bundle_ids と、認証情報として
+    api_credentials_secret または key_id / issuer_id / key_path を指定する。
+    """
+    from extract_bundle_id import load_environment_config, apply_environment_suffix
+    
+    config = load_environment_config()
+    if not config:
+        return []
+    
+    secret_base = os.environ.get('API_CREDENTIALS_SECRET_BASE', 'apple-certificate-update')
+    targets = []
+    
+    for environment, env_config in config.get('environments', {}).items():
+        env_suffix = env_config.get('secret_name_suffix') or ('prd' if environment == 'main' else environment)
+        bundle_ids = env_config.get('bundle_ids') or apply_environment_suffix(base_bundle_ids, environment)
+        targets.append({
+            'name': environment,
+            'bundle_ids': bundle_ids,
+            'api_credentials_secret': env_config.get(
+                'api_credentials_secret', f"{secret_base}/api-credentials-{env_suffix}"
+            ),
+        })
+    
+    for team in config.get('teams', []):
+        targets.append(dict(team))
+    
+    return targets
+
+
+def create_api_for_target(target, region_name):
+    """チェック対象ごとの API クライアントを作成"""
+    if target.get('api_credentials_secret'):
+        from get_api_credentials import fetch_secret
+        credentials = fetch_secret(target['api_credentials_secret'], region_name)
+        return AppStoreConnectAPI(
+            credentials['key_id'],
+            credentials['issuer_id'],
+            private_key=credentials['private_key']
+        )
+    
+    return AppStoreConnectAPI(target['key_id'], target['issuer_id'], target['key_path'])
+
+
+def check_fleet_target(target, region_name, days_threshold):
+    """1つのチェック対象（環境・チーム）の証明書有効期限をチェック"""
+    name = target['name']
+    bundle_ids = target.get('bundle_ids') or []
+    if not bundle_ids:
+        return {'name': name, 'error': 'Bundle IDが指定されていません', 'needs_update': True}
+    
+    try:
+        api = create_api_for_target(target, region_name)
+    except Exception as e:
+        print(f"エラー: {name} の認証情報の取得に失敗しました: {e}", file=sys.stderr)
+        return {'name': name, 'bundle_ids': bundle_ids, 'error': str(e), 'needs_update': True}
+    
+    try:
+        print(f"\n[{name}] 証明書の有効期限をチェックしています...")
+        result, needs_update = check_certificate_expiry_for_bundle_ids(
+            api, bundle_ids, days_threshold=days_threshold
+        )
+        return {
+            'name': name,
+            'bundle_ids': bundle_ids,
+            'result': result,
+            'needs_update': needs_update,
+            'api_usage': api.rate_limiter.stats()
+        }
+    finally:
+        api.close()
+
+
+def run_fleet_check(days_threshold=30):
+    """すべての環境・チームの証明書を1プロセスでまとめてチェック"""
+    region_name = os.environ.get('AWS_REGION', 'ap-northeast-1')
+    max_workers = int(os.environ.get('FLEET_MAX_WORKERS', '4'))
+    output_path = os.environ.get('FLEET_RESULT_PATH', '/tmp/fleet_certificate_check_result.json')
+    
+    targets = load_fleet_targets(get_bundle_ids_from_output() or [])
+    if not targets:
+        print("エラー: チェック対象の環境が見つかりません", file=sys.stderr)
+        sys.exit(1)
+    
+    print(f"フリートモード: {len(targets)} 件の環境・チームをチェックします")
+    
+    # 対象ごとに独立したクライアントで並行チェック（結果は対象の定義順）
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(targets)))) as executor:
+        results = list(executor.map(
+            lambda target: check_fleet_target(target, region_name, days_threshold),
+            targets
+        ))
+    
+    needs_update_targets = [r['name'] for r in results if r['needs_update']]
+    
+    print("\nフリートチェック結果:")
+    for r in results:
+        status = "更新必要" if r['needs_update'] else "更新不要"
+        detail = r.get('error') or (
+            f"残り{r['result']['days_remaining']}日" if r.get('result') else "証明書情報なし"
+        )
+        print(f"  - {r['name']}: {status} ({detail})")
+    
+    with open(output_path, 'w') as f:
+        json.dump({
+            'checked_at': datetime.utcnow().isoformat(),
+            'needs_update': bool(needs_update_targets),
+            'needs_update_targets': needs_update_targets,
+            'targets': results
+        }, f, indent=2)
+    print(f"\n結果を保存しました: {output_path}")
+    
+    if 'GITHUB_OUTPUT' in os.environ:
+        with open(os.environ['GITHUB_OUTPUT'], 'a') as f:
+            f.write(f"needs_update={'true' if needs_update_targets else 'false'}\n")
+            f.write(f"needs_update_targets={json.dumps(needs_update_targets)}\n")
+
+
+# ローカルチェックで API 確認を省略するために必要な、しきい値からの余裕日数
+LOCAL_CHECK_MARGIN_DAYS = int(os.environ.get('LOCAL_CHECK_MARGIN_DAYS', '14'))
+
+
+def load_certificate_from_secret(secret_data):
+    """Secrets Manager に保存された証明書（.cer または .p12）をパース"""
+    if secret_data.get('certificate'):
+        cert_bytes = base64.b64decode(secret_data['certificate'])
+        try:
+            return x509.load_der_x509_certificate(cert_bytes)
+        except ValueError:
+            return x509.load_pem_x509_certificate(cert_bytes)
+    
+    if secret_data.get('p12'):
+        password = secret_data.get('p12_password') or None
+        _, certificate, _ = pkcs12.load_key_and_certificates(
+            base64.b64decode(secret_data['p12']),
+            password.encode('utf-8') if password else None
+        )
+        return certificate
+    
+    return None
+
+
+def get_certificate_expiry(certificate):
+    """証明書の notAfter を UTC の datetime で返す"""
+    if hasattr(certificate, 'not_valid_after_utc'):
+        return certificate.not_valid_after_utc
+    return certificate.not_valid_after.replace(tzinfo=timezone.utc)
+
+
+def check_certificate_expiry_from_secret(bundle_ids, environment, days_threshold=30,
+                                         margin_days=LOCAL_CHECK_MARGIN_DAYS):
+    """保存済みの証明書をローカルでパースして有効期限をチェック
+    
+    有効期限に十分な余裕があり、保存済みの内容が対象のBundle IDと整合する場合のみ
+    結果を返す。それ以外（しきい値付近・不整合・取得失敗）は None を返し、
+    App Store Connect API でのチェックにフォールバックする。
+    """
+    from get_api_credentials import fetch_secret
+    
+    region_name = os.environ.get('AWS_REGION', 'ap-northeast-1')
+    secret_base_name = os.environ.get('CERTIFICATE_SECRET_BASE_NAME', 'apple-certificate-update')
+    env_suffix = 'prd' if environment == 'main' else environment
+    secret_name = f"{secret_base_name}/distribution-certificate-{env_suffix}"
+    
+    print(f"保存済みの証明書を確認しています: {secret_name}")
+    
+    try:
+        secret_data = fetch_secret(secret_name, region_name)
+        certificate = load_certificate_from_secret(secret_data)
+    except Exception as e:
+        print(f"警告: 保存済みの証明書を読み込めませんでした: {e}", file=sys.stderr)
+        return None
+    
+    if certificate is None:
+        print("警告: シークレットに証明書が含まれていません", file=sys.stderr)
+        return None
+    
+    # 保存済みの証明書が対象のBundle IDをカバーしているか確認
+    stored_bundle_ids = secret_data.get('bundle_ids') or []
+    missing_bundle_ids = [b for b in bundle_ids if b not in stored_bundle_ids]
+    if missing_bundle_ids:
+        print(f"保存済みの証明書に含まれないBundle IDがあります: {missing_bundle_ids}")
+        return None
+    
+    expiry_date = get_certificate_expiry(certificate)
+    days_remaining = (expiry_date - datetime.now(timezone.utc)).days
+    serial_number = format(certificate.serial_number, 'X')
+    
+    print(f"  シリアル番号: {serial_number}")
+    print(f"  有効期限: {expiry_date.strftime('%Y-%m-%d %H:%M:%S')}")
+    print(f"  残り日数: {days_remaining}日")
+    
+    if days_remaining <= days_threshold + margin_days:
+        print("有効期限がしきい値に近いため、App Store Connect API で確認します")
+        return None
+    
+    return {
+        'certificate_id': None,
+        'serial_number': serial_number,
+        'bundle_id': bundle_ids[0],
+        'expiry_date': expiry_date.strftime('%Y-%m-%d'),
+        'days_remaining': days_remaining,
+        'needs_update': False,
+        'source': 'secrets_manager'
+    }
+
+
+# 有効期限スナップショットの保存先（ファイルまたはシークレット、未設定の場合は無効）
+EXPIRY_SNAPSHOT_PATH = os.environ.get('EXPIRY_SNAPSHOT_PATH')
+EXPIRY_SNAPSHOT_SECRET = os.environ.get('EXPIRY_SNAPSHOT_SECRET')
+
+
+def load_expiry_snapshot():
+    """前回チェック時の有効期限スナップショットを読み込む"""
+    try:
+        if EXPIRY_SNAPSHOT_PATH:
+            if not os.path.exists(EXPIRY_SNAPSHOT_PATH):
+                return None
+            with open(EXPIRY_SNAPSHOT_PATH, 'r') as f:
+                return json.load(f)
+        if EXPIRY_SNAPSHOT_SECRET:
+            from get_api_credentials import fetch_secret
+            return fetch_secret(EXPIRY_SNAPSHOT_SECRET, os.environ.get('AWS_REGION', 'ap-northeast-1'))
+    except Exception as e:
+        print(f"警告: スナップショットの読み込みに失敗しました: {e}", file=sys.stderr)
+    return None
+
+
+def save_expiry_snapshot(result, bundle_ids, environment):
+    """チェック結果を有効期限スナップショットとして保存"""
+    snapshot = {
+        'environment': environment,
+        'certificate_id': result.get('certificate_id'),
+        'expiry_date': result['expiry_date'],
+        'bundle_ids': bundle_ids,
+        'checked_at': datetime.utcnow().isoformat()
+    }
+    
+    try:
+        if EXPIRY_SNAPSHOT_PATH:
+            os.makedirs(os.path.dirname(os.path.abspath(EXPIRY_SNAPSHOT_PATH)), exist_ok=True)
+            with open(EXPIRY_SNAPSHOT_PATH, 'w') as f:
+                json.dump(snapshot, f, indent=2)
+        elif EXPIRY_SNAPSHOT_SECRET:
+            from upload_to_secrets_manager import upload_to_secrets_manager
+            upload_to_secrets_manager(
+                snapshot, EXPIRY_SNAPSHOT_SECRET, os.environ.get('AWS_REGION', 'ap-northeast-1')
+            )
+        else:
+            return
+        print("有効期限スナップショットを保存しました")
+    except Exception as e:
+        print(f"警告: スナップショットの保存に失敗しました: {e}", file=sys.stderr)
+
+
+def check_certificate_expiry_from_snapshot(bundle_ids, environment, days_threshold=30,
+                                           margin_days=LOCAL_CHECK_MARGIN_DAYS):
+    """スナップショットの有効期限に十分な余裕があれば、リモート処理なしで結果を返す"""
+    snapshot = load_expiry_snapshot()
+    if not snapshot:
+        return None
+    
+    if snapshot.get('environment') != environment:
+        return None
+    if any(b not in (snapshot.get('bundle_ids') or []) for b in bundle_ids):
+        return None
+    
+    # 日付のみ保存しているため、当日の0時（UTC）を有効期限とみなす（安全側）
+    expiry_date = datetime.strptime(snapshot['expiry_date'], '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    days_remaining = (expiry_date - datetime.now(timezone.utc)).days
+    
+    print(f"スナップショット（{snapshot.get('checked_at')} 時点）の有効期限: "
+          f"{snapshot['expiry_date']}（残り{days_remaining}日）")
+    
+    if days_remaining <= days_threshold + margin_days:
+        return None
+    
+    return {
+        'certificate_id': snapshot.get('certificate_id'),
+        'bundle_id': bundle_ids[0],
+        'expiry_date': snapshot['expiry_date'],
+        'days_remaining': days_remaining,
+        'needs_update': False,
+        'source': 'snapshot'
+    }
+
+
 def main():
+    # フリートモード（全環境・チームをまとめてチェック）
+    if os.environ.get('FLEET_MODE', 'false').lower() == 'true':
+        run_fleet_check()
+        return
+    
     # 環境変数から設定を取得
     key_id = os.environ.get('APP_STORE_CONNECT_KEY_ID')
     issuer_id = os.environ.get('APP_STORE_CONNECT_ISSUER_ID')
     key_path = os.environ.get('APP_STORE_CONNECT_KEY_PATH', '/tmp/AuthKey.p8')
     force_update = os.environ.get('FORCE_UPDATE', 'false').lower() == 'true'
+    local_check = os.environ.get('LOCAL_CERTIFICATE_CHECK', 'false').lower() == 'true'
+    environment = os.environ.get('ENVIRONMENT', 'main')
     
     if not all([key_id, issuer_id, key_path]):
         print("エラー: API認証情報が設定されていません", file=sys.stderr)
@@ -206,8 +1077,30 @@ def main():
         }
         needs_update = True
     else:
-        # 証明書の有効期限をチェック
-        result, needs_update = check_certificate_expiry_for_bundle_ids(api, bundle_ids)
+        # 前回のスナップショットで判定できる場合はリモート処理をすべて省略
+        result = check_certificate_expiry_from_snapshot(bundle_ids, environment)
+        
+        # 保存済みの証明書で判定できる場合は API を呼び出さない
+        if not result and local_check:
+            result = check_certificate_expiry_from_secret(bundle_ids, environment)
+        
+        if result:
+            needs_update = False
+        else:
+            # 証明書の有効期限をチェック
+            result, needs_update = check_certificate_expiry_for_bundle_ids(api, bundle_ids)
+        
+        # 次回以降のチェック用にスナップショットを更新
+        if result and result.get('source') != 'snapshot':
+            save_expiry_snapshot(result, bundle_ids, environment)
+    
+    # API の使用状況を出力
+    api_usage = api.rate_limiter.stats()
+    print(f"\nAPI使用状況: リクエスト {api_usage['requests']}回, "
+          f"リトライ {api_usage['retries']}回, 429 {api_usage['throttled']}回, "
+          f"クォータ残り {api_usage['quota_remaining']}/{api_usage['quota_limit']}")
+    if result:
+        result['api_usage'] = api_usage
     
     # 結果を出力
     if needs_update:
@@ -219,10 +1112,11 @@ def main():
     if 'GITHUB_OUTPUT' in os.environ:
         with open(os.environ['GITHUB_OUTPUT'], 'a') as f:
             f.write(f"needs_update={'true' if needs_update else 'false'}\n")
+            f.write(f"api_requests={api_usage['requests']}\n")
             if result and not force_update:
                 f.write(f"expiry_date={result.get('expiry_date', 'unknown')}\n")
                 f.write(f"days_remaining={result.get('days_remaining', 'unknown')}\n")
-                f.write(f"certificate_id={result.get('certificate_id', 'unknown')}\n")
+                f.write(f"certificate_id={result.get('certificate_id') or 'unknown'}\n")
                 f.write(f"bundle_id={result.get('bundle_id', 'unknown')}\n")
     
     # 結果をファイルに保存（後続のスクリプトで使用）
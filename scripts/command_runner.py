@@ -0,0 +1,142 @@
+"""
+外部コマンド（fastlane など）を実行するモジュール
+
+標準出力・標準エラーはバッファせずに1行ずつログへ流し、タイムアウトした
+場合はプロセスグループごと終了させる。各コマンドの実行時間と終了ステータスは
+記録され、複数のスレッドから同時に実行できる。
+"""
+import os
+import sys
+import time
+import signal
+import threading
+import subprocess
+from collections import deque
+
+
+# コマンドのタイムアウト（秒）のデフォルト値
+DEFAULT_COMMAND_TIMEOUT = float(os.environ.get('COMMAND_TIMEOUT', '900'))
+# SIGTERM を送ってから SIGKILL するまでの猶予（秒）
+KILL_GRACE_PERIOD = 10
+# 失敗時の確認用に保持する末尾の行数
+TAIL_LINES = 50
+
+# 出力の行が混ざらないようにするためのロック
+_output_lock = threading.Lock()
+# 実行したコマンドの記録
+_history = []
+_history_lock = threading.Lock()
+
+
+class CommandResult:
+    """コマンドの実行結果"""
+    
+    def __init__(self, label, args, returncode, duration, timed_out, stdout_tail, stderr_tail):
+        self.label = label
+        self.args = args
+        self.returncode = returncode
+        self.duration = duration
+        self.timed_out = timed_out
+        self.stdout_tail = stdout_tail
+        self.stderr_tail = stderr_tail
+    
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+    
+    def to_dict(self):
+        return {
+            'label': self.label,
+            'returncode': self.returncode,
+            'duration': round(self.duration, 2),
+            'timed_out': self.timed_out,
+        }
+
+
+def _stream(pipe, label, output, tail):
+    """パイプを1行ずつ読み、ラベルを付けて出力"""
+    with pipe:
+        for line in pipe:
+            line = line.rstrip('\n')
+            tail.append(line)
+            with _output_lock:
+                print(f"[{label}] {line}", file=output, flush=True)
+
+
+def _kill_process_group(process):
+    """プロセスグループに SIGTERM を送り、終了しなければ SIGKILL"""
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=KILL_GRACE_PERIOD)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def run_command(args, env=None, timeout=DEFAULT_COMMAND_TIMEOUT, label=None, cwd=None):
+    """コマンドを実行し、出力を逐次ログに流して CommandResult を返す
+    
+    子プロセスは新しいプロセスグループで起動するため、タイムアウト時は
+    fastlane が起動した孫プロセスもまとめて終了する。
+    コマンドが見つからない場合などは OSError を送出する。
+    """
+    label = label or os.path.basename(args[0])
+    started_at = time.monotonic()
+    process = subprocess.Popen(
+        args,
+        env=env,
+        cwd=cwd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        errors='replace',
+        bufsize=1,
+        start_new_session=True
+    )
+    
+    stdout_tail = deque(maxlen=TAIL_LINES)
+    stderr_tail = deque(maxlen=TAIL_LINES)
+    readers = [
+        threading.Thread(target=_stream, args=(process.stdout, label, sys.stdout, stdout_tail), daemon=True),
+        threading.Thread(target=_stream, args=(process.stderr, label, sys.stderr, stderr_tail), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+    
+    timed_out = False
+    try:
+        returncode = process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+        print(f"警告: {label} が {timeout:.0f} 秒以内に終了しなかったため停止します", file=sys.stderr)
+        _kill_process_group(process)
+        returncode = process.wait()
+    
+    # 正常終了後も子プロセス（fastlane が起動したものなど）がパイプを保持している
+    # 場合があるため、残ったプロセスグループを終了させ、読み取りも上限付きで待つ
+    if not timed_out:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+    for reader in readers:
+        reader.join(timeout=KILL_GRACE_PERIOD)
+    
+    result = CommandResult(
+        label, list(args), returncode, time.monotonic() - started_at, timed_out,
+        list(stdout_tail), list(stderr_tail)
+    )
+    with _history_lock:
+        _history.append(result)
+    
+    status = 'タイムアウト' if timed_out else f"終了コード {returncode}"
+    print(f"{label}: {status}（{result.duration:.1f} 秒）")
+    return result
+
+
+def command_history():
+    """これまでに実行したコマンドの結果（実行順）"""
+    with _history_lock:
+        return list(_history)
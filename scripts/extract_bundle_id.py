@@ -3,70 +3,488 @@
 Xcodeプロジェクトファイルから Bundle ID を抽出するスクリプト
 """
 import os
-import re
 import json
 import sys
+import fnmatch
+import hashlib
+import plistlib
+import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pbxproj_parser import load_build_configuration_index, PbxprojParseError
+from build_settings import BuildSettingsResolver
 from pathlib import Path
 
 
-def find_xcodeproj():
-    """リポジトリ内の .xcodeproj ファイルを検索"""
+# 探索しないディレクトリ（依存ライブラリ・ビルド成果物など）
+DEFAULT_IGNORE_DIRS = [
+    '.git', 'Pods', 'node_modules', 'DerivedData', 'Carthage', 'build', '.build', '.swiftpm'
+]
+
+
+def load_ignore_patterns(root, extra_patterns=None, use_gitignore=True):
+    """除外パターンを読み込む（デフォルト + 追加指定 + .gitignore）"""
+    patterns = list(DEFAULT_IGNORE_DIRS)
+    
+    env_patterns = os.environ.get('XCODEPROJ_IGNORE', '')
+    patterns.extend(p.strip() for p in env_patterns.split(',') if p.strip())
+    
+    if extra_patterns:
+        patterns.extend(extra_patterns)
+    
+    gitignore_path = Path(root) / '.gitignore'
+    if use_gitignore and gitignore_path.exists():
+        with open(gitignore_path, 'r', encoding='utf-8', errors='ignore') as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if line.strip() and not line.startswith('#'):
+                    patterns.append(line.strip())
+    
+    return patterns
+
+
+def is_ignored(rel_path, name, is_dir, patterns):
+    """.gitignore 形式のパターンに一致するか判定（後のパターンが優先）"""
+    ignored = False
+    for pattern in patterns:
+        negate = pattern.startswith('!')
+        if negate:
+            pattern = pattern[1:]
+        
+        dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        if not pattern or (dir_only and not is_dir):
+            continue
+        
+        # スラッシュを含むパターンはルートからの相対パスで照合
+        if '/' in pattern:
+            matched = fnmatch.fnmatch(rel_path, pattern.lstrip('/'))
+        else:
+            matched = fnmatch.fnmatch(name, pattern)
+        
+        if matched:
+            ignored = not negate
+    
+    return ignored
+
+
+def walk_for_projects(root, suffixes=('.xcodeproj',), ignore_patterns=None,
+                      use_gitignore=True, max_depth=None, stop_at_first=False):
+    """除外ディレクトリを枝刈りしながら幅優先でプロジェクトを探索
+    
+    プロジェクトのディレクトリ（.xcodeproj など）の中には降りない。
+    stop_at_first を指定すると、最初に見つかった階層の結果だけを返す。
+    """
+    root = Path(root)
+    patterns = load_ignore_patterns(root, ignore_patterns, use_gitignore)
+    
+    found = []
+    queue = deque([(root, 0)])
+    current_depth = 0
+    
+    while queue:
+        directory, depth = queue.popleft()
+        
+        # 1つ上の階層で見つかっていれば、それより深い階層は探索しない
+        if stop_at_first and found and depth > current_depth:
+            break
+        current_depth = depth
+        
+        try:
+            entries = sorted(os.scandir(directory), key=lambda e: e.name)
+        except OSError:
+            continue
+        
+        for entry in entries:
+            try:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+            except OSError:
+                continue
+            
+            rel_path = os.path.relpath(entry.path, root).replace(os.sep, '/')
+            if is_ignored(rel_path, entry.name, True, patterns):
+                continue
+            
+            if entry.name.endswith(suffixes):
+                found.append(Path(entry.path))
+            elif max_depth is None or depth < max_depth:
+                queue.append((Path(entry.path), depth + 1))
+    
+    return found
+
+
+def resolve_workspace_projects(workspace_path):
+    """.xcworkspace の contents.xcworkspacedata から参照されている .xcodeproj を取得"""
+    contents_path = Path(workspace_path) / 'contents.xcworkspacedata'
+    if not contents_path.exists():
+        return []
+    
+    try:
+        tree = ET.parse(contents_path)
+    except ET.ParseError as e:
+        print(f"警告: {contents_path} の解析に失敗しました: {e}", file=sys.stderr)
+        return []
+    
+    workspace_dir = Path(workspace_path).parent
+    projects = []
+    
+    def resolve_location(location, base_dir):
+        kind, _, path = location.partition(':')
+        if kind == 'absolute':
+            return Path(path)
+        if kind in ('group', 'container', 'self'):
+            # container/self はワークスペースのディレクトリ基準、group は親グループ基準
+            return (workspace_dir if kind != 'group' else base_dir) / path
+        return None
+    
+    def visit(element, base_dir):
+        for child in element:
+            location = child.get('location', '')
+            resolved = resolve_location(location, base_dir) if location else None
+            if child.tag == 'Group':
+                visit(child, resolved or base_dir)
+            elif child.tag == 'FileRef' and resolved and resolved.suffix == '.xcodeproj':
+                projects.append(resolved)
+    
+    visit(tree.getroot(), workspace_dir)
+    return projects
+
+
+def find_xcodeprojs():
+    """リポジトリ内の .xcodeproj（.xcworkspace から参照されるものを含む）をすべて検索"""
     current_dir = Path.cwd()
-    xcodeproj_files = list(current_dir.glob("**/*.xcodeproj"))
+    max_depth = os.environ.get('XCODEPROJ_MAX_DEPTH')
+    found = walk_for_projects(
+        current_dir,
+        suffixes=('.xcodeproj', '.xcworkspace'),
+        max_depth=int(max_depth) if max_depth else None,
+        stop_at_first=os.environ.get('XCODEPROJ_STOP_AT_FIRST', 'false').lower() == 'true'
+    )
+    
+    # ワークスペースから参照されるプロジェクトにも除外ルールを適用
+    patterns = load_ignore_patterns(current_dir)
+    
+    def is_ignored_path(path):
+        rel_parts = os.path.relpath(path, current_dir).replace(os.sep, '/').split('/')
+        return any(
+            is_ignored('/'.join(rel_parts[:i + 1]), part, True, patterns)
+            for i, part in enumerate(rel_parts)
+        )
+    
+    xcodeproj_files = []
+    seen = set()
+    for path in found:
+        if path.suffix == '.xcworkspace':
+            candidates = [p for p in resolve_workspace_projects(path) if not is_ignored_path(p)]
+        else:
+            candidates = [path]
+        for candidate in candidates:
+            resolved = candidate.resolve()
+            if resolved not in seen and (resolved / 'project.pbxproj').exists():
+                seen.add(resolved)
+                xcodeproj_files.append(candidate)
     
     if not xcodeproj_files:
         print("エラー: .xcodeproj ファイルが見つかりません", file=sys.stderr)
         sys.exit(1)
     
-    if len(xcodeproj_files) > 1:
-        print(f"警告: 複数の .xcodeproj ファイルが見つかりました。最初のファイルを使用します: {xcodeproj_files[0]}")
+    return xcodeproj_files
+
+
+def get_configuration_filter():
+    """対象とするビルド構成名（BUNDLE_ID_CONFIGURATIONS、未指定の場合はすべて）"""
+    names = os.environ.get('BUNDLE_ID_CONFIGURATIONS', '')
+    names = [name.strip() for name in names.split(',') if name.strip()]
+    return set(names) or None
+
+
+def load_build_settings_resolver(pbxproj_path):
+    """project.pbxproj を解析してビルド設定の評価器を作成（失敗時は None）"""
+    try:
+        index = load_build_configuration_index(pbxproj_path)
+    except (PbxprojParseError, UnicodeDecodeError) as e:
+        print(f"警告: {pbxproj_path} の解析に失敗しました: {e}", file=sys.stderr)
+        return None
+    return BuildSettingsResolver(index, Path(pbxproj_path).parent)
+
+
+def extract_bundle_id_entries_from_pbxproj(pbxproj_path, configuration_names=None, resolver=None):
+    """project.pbxproj から Bundle ID をターゲット・ビルド構成と合わせて抽出
+    
+    $(VARIABLE) を含む値は .xcconfig を含むビルド設定から解決する。
+    """
+    resolver = resolver or load_build_settings_resolver(pbxproj_path)
+    if resolver is None:
+        return []
     
-    return xcodeproj_files[0]
+    index = resolver.index
+    # ターゲットの値はプロジェクトレベルの設定を継承して評価する
+    configurations = [
+        (target, configuration)
+        for target, configuration, _ in index.iter_configurations(configuration_names)
+        if target is not None or not index.targets
+    ]
+    
+    entries = []
+    for target, configuration in configurations:
+        bundle_id = resolver.resolve(target, configuration, 'PRODUCT_BUNDLE_IDENTIFIER')
+        # 解決できない変数参照を含むものは除外
+        if bundle_id and bundle_id.strip():
+            entries.append({
+                'bundle_id': bundle_id.strip(),
+                'target': target,
+                'configuration': configuration
+            })
+    
+    return entries
 
 
 def extract_bundle_id_from_pbxproj(pbxproj_path):
     """project.pbxproj ファイルから Bundle ID を抽出"""
-    bundle_ids = set()
+    bundle_ids = []
+    for entry in extract_bundle_id_entries_from_pbxproj(pbxproj_path, get_configuration_filter()):
+        if entry['bundle_id'] not in bundle_ids:
+            bundle_ids.append(entry['bundle_id'])
+    return bundle_ids
+
+
+def find_info_plists(project_dir):
+    """プロジェクトディレクトリ内の Info.plist を検索（除外ディレクトリは探索しない）"""
+    info_plists = []
+    for dirpath, dirnames, filenames in os.walk(project_dir):
+        dirnames[:] = sorted(
+            d for d in dirnames
+            if d not in DEFAULT_IGNORE_DIRS and not d.endswith(('.xcodeproj', '.xcworkspace'))
+        )
+        if 'Info.plist' in filenames:
+            info_plists.append(Path(dirpath) / 'Info.plist')
+    return info_plists
+
+
+def read_bundle_id_from_plist(plist_path):
+    """Info.plist（XML / バイナリ）から CFBundleIdentifier を読み取る"""
+    try:
+        with open(plist_path, 'rb') as f:
+            plist = plistlib.load(f)
+    except Exception as e:
+        print(f"警告: {plist_path} の読み取りに失敗しました: {e}", file=sys.stderr)
+        return None
     
-    with open(pbxproj_path, 'r', encoding='utf-8') as f:
-        content = f.read()
+    bundle_id = plist.get('CFBundleIdentifier') if isinstance(plist, dict) else None
+    return bundle_id.strip() if isinstance(bundle_id, str) and bundle_id.strip() else None
+
+
+def map_info_plists_to_targets(resolver, configuration_names=None):
+    """INFOPLIST_FILE から Info.plist のパス → [(ターゲット, 構成)] を作成"""
+    plist_targets = {}
+    for target, configuration, _ in resolver.index.iter_configurations(configuration_names):
+        if target is None:
+            continue
+        info_plist = resolver.resolve(target, configuration, 'INFOPLIST_FILE')
+        if info_plist:
+            path = os.path.normpath(os.path.join(resolver.source_root, info_plist))
+            plist_targets.setdefault(path, []).append((target, configuration))
+    return plist_targets
+
+
+def extract_bundle_id_entries_from_plists(xcodeproj_path, resolver=None, configuration_names=None,
+                                          max_workers=None, info_plists=None):
+    """Info.plist から Bundle ID を読み取り、ファイルの出自と合わせて返す
+    
+    resolver を指定すると、$(VARIABLE) を含む値を Info.plist を使用する
+    ターゲットのビルド設定で解決する。info_plists を省略した場合は検索する。
+    """
+    if info_plists is None:
+        info_plists = find_info_plists(Path(xcodeproj_path).parent)
+    if not info_plists:
+        return []
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        bundle_ids = list(executor.map(read_bundle_id_from_plist, info_plists))
     
-    # PRODUCT_BUNDLE_IDENTIFIER のパターンを検索
-    pattern = r'PRODUCT_BUNDLE_IDENTIFIER\s*=\s*"?([^";]+)"?;'
-    matches = re.findall(pattern, content)
+    plist_targets = map_info_plists_to_targets(resolver, configuration_names) if resolver else {}
     
-    for match in matches:
-        # 変数参照を除外（$(...)を含むもの）
-        if not '$(' in match:
-            bundle_ids.add(match.strip())
+    entries = []
+    for plist_path, bundle_id in zip(info_plists, bundle_ids):
+        if not bundle_id:
+            continue
+        targets = plist_targets.get(os.path.normpath(os.path.abspath(plist_path)), [])
+        
+        if '$' not in bundle_id:
+            entries.append({'bundle_id': bundle_id, 'file': str(plist_path),
+                            'target': targets[0][0] if targets else None,
+                            'configuration': targets[0][1] if targets else None})
+            continue
+        
+        # 変数参照はターゲットのビルド設定で解決（解決できないものは除外）
+        for target, configuration in targets:
+            resolved = resolver.expand(target, configuration, bundle_id)
+            if resolved and resolved.strip():
+                entries.append({'bundle_id': resolved.strip(), 'file': str(plist_path),
+                                'target': target, 'configuration': configuration})
     
-    return list(bundle_ids)
+    return entries
 
 
 def extract_bundle_id_from_plist(xcodeproj_path):
     """Info.plist から Bundle ID を抽出（フォールバック）"""
-    project_dir = xcodeproj_path.parent
-    info_plists = list(project_dir.glob("**/Info.plist"))
-    
     bundle_ids = []
+    for entry in extract_bundle_id_entries_from_plists(xcodeproj_path):
+        if entry['bundle_id'] not in bundle_ids:
+            bundle_ids.append(entry['bundle_id'])
+    return bundle_ids
+
+
+def extract_bundle_ids_from_project(xcodeproj_path):
+    """1つの .xcodeproj から Bundle ID を出自（プロジェクト・ターゲット）付きで抽出
     
-    for plist_path in info_plists:
-        try:
-            # plistbuddy を使用してBundle IDを読み取る
-            import subprocess
-            result = subprocess.run(
-                ['/usr/libexec/PlistBuddy', '-c', 'Print :CFBundleIdentifier', str(plist_path)],
-                capture_output=True,
-                text=True
+    抽出結果と、解析に使用した入力（ファイル・環境変数・検索した Info.plist）を返す。
+    プロセスプールから呼び出されるため、トップレベル関数として定義している。
+    """
+    xcodeproj_path = Path(xcodeproj_path)
+    pbxproj_path = xcodeproj_path / "project.pbxproj"
+    
+    configuration_names = get_configuration_filter()
+    resolver = load_build_settings_resolver(pbxproj_path)
+    
+    entries = []
+    if resolver:
+        entries = [
+            dict(entry, project=str(xcodeproj_path), file=str(pbxproj_path), source='pbxproj')
+            for entry in extract_bundle_id_entries_from_pbxproj(pbxproj_path, configuration_names, resolver)
+        ]
+    
+    # Bundle ID が見つからない場合は Info.plist から取得を試みる
+    info_plists = {}
+    if not entries:
+        project_dir = str(xcodeproj_path.parent)
+        found = find_info_plists(project_dir)
+        info_plists[project_dir] = sorted(str(path) for path in found)
+        entries = [
+            dict(entry, project=str(xcodeproj_path), source='plist')
+            for entry in extract_bundle_id_entries_from_plists(
+                xcodeproj_path, resolver, configuration_names, info_plists=found
             )
-            if result.returncode == 0 and result.stdout.strip():
-                bundle_id = result.stdout.strip()
-                if not '$(' in bundle_id:  # 変数参照を除外
-                    bundle_ids.append(bundle_id)
-        except Exception as e:
-            print(f"警告: {plist_path} の読み取りに失敗しました: {e}", file=sys.stderr)
+        ]
     
-    return bundle_ids
+    input_files = {str(pbxproj_path)}
+    input_files.update(entry['file'] for entry in entries)
+    # Bundle ID を含まなかった Info.plist も、後から追加された場合に備えて入力とする
+    for paths in info_plists.values():
+        input_files.update(paths)
+    if resolver:
+        input_files.update(resolver.xcconfig_files)
+    
+    inputs = {
+        'files': sorted(input_files),
+        'environ': dict(resolver.referenced_environ) if resolver else {},
+        'info_plists': info_plists,
+    }
+    return entries, inputs
+
+
+def extract_bundle_ids_from_projects(xcodeproj_paths, max_workers=None):
+    """複数プロジェクトを並列に解析し、重複を除いた Bundle ID・出自・入力を返す"""
+    if len(xcodeproj_paths) == 1:
+        results = [extract_bundle_ids_from_project(xcodeproj_paths[0])]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            # map は入力順に結果を返すため、マージ結果の順序は安定する
+            results = list(executor.map(extract_bundle_ids_from_project, xcodeproj_paths))
+    
+    bundle_ids = []
+    sources = {}
+    inputs = {'files': [], 'environ': {}, 'info_plists': {}}
+    for entries, project_inputs in results:
+        inputs['files'].extend(f for f in project_inputs['files'] if f not in inputs['files'])
+        inputs['environ'].update(project_inputs['environ'])
+        inputs['info_plists'].update(project_inputs['info_plists'])
+        for entry in entries:
+            bundle_id = entry['bundle_id']
+            if bundle_id not in sources:
+                bundle_ids.append(bundle_id)
+                sources[bundle_id] = []
+            source = {k: entry[k] for k in ('project', 'file', 'target', 'configuration', 'source')}
+            if source not in sources[bundle_id]:
+                sources[bundle_id].append(source)
+    
+    return bundle_ids, sources, inputs
+
+
+def file_fingerprint(path, previous=None):
+    """ファイルのサイズ・更新日時・内容ハッシュを取得
+    
+    サイズと更新日時が前回と同じ場合はハッシュの計算を省略する。
+    """
+    stat = os.stat(path)
+    if previous and previous.get('size') == stat.st_size and previous.get('mtime') == stat.st_mtime_ns:
+        return previous
+    
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': digest.hexdigest()}
+
+
+def get_cache_path(cache_dir, xcodeproj_paths, environment):
+    """対象プロジェクト・環境・構成の組み合わせごとのキャッシュファイルのパス"""
+    key = json.dumps({
+        'projects': sorted(str(Path(p).resolve()) for p in xcodeproj_paths),
+        'environment': environment,
+        'configurations': sorted(get_configuration_filter() or []),
+        'environment_config': (load_environment_config() or {}).get('environments', {}).get(environment),
+    }, sort_keys=True)
+    return Path(cache_dir) / f"bundle_ids-{hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]}.json"
+
+
+def load_cached_bundle_ids(cache_path):
+    """入力（ファイル・参照した環境変数・Info.plist の一覧）が変更されていなければキャッシュ済みの結果を返す"""
+    if not cache_path.exists():
+        return None
+    
+    try:
+        with open(cache_path, 'r') as f:
+            cached = json.load(f)
+        
+        for name, value in cached['environ'].items():
+            if os.environ.get(name) != value:
+                return None
+        
+        for project_dir, paths in cached['info_plists'].items():
+            if sorted(str(path) for path in find_info_plists(project_dir)) != paths:
+                return None
+        
+        inputs = {}
+        for path, fingerprint in cached['inputs'].items():
+            if not os.path.exists(path):
+                return None
+            current = file_fingerprint(path, fingerprint)
+            if current['sha256'] != fingerprint['sha256']:
+                return None
+            inputs[path] = current
+    except (OSError, ValueError, KeyError) as e:
+        print(f"警告: キャッシュの読み込みに失敗しました: {e}", file=sys.stderr)
+        return None
+    
+    # 更新日時だけが変わった場合は、次回ハッシュ計算を省略できるよう記録し直す
+    if inputs != cached['inputs']:
+        cached['inputs'] = inputs
+        save_cached_bundle_ids(cache_path, cached)
+    
+    return cached
+
+
+def save_cached_bundle_ids(cache_path, cached):
+    """抽出結果をキャッシュに保存"""
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(cache_path, 'w') as f:
+            json.dump(cached, f, indent=2, ensure_ascii=False)
+    except OSError as e:
+        print(f"警告: キャッシュの保存に失敗しました: {e}", file=sys.stderr)
 
 
 def load_environment_config():
@@ -110,30 +528,55 @@ def main():
     print(f"環境: {environment}")
     
     # Xcodeプロジェクトを検索
-    xcodeproj_path = find_xcodeproj()
-    print(f"Xcodeプロジェクトを検出: {xcodeproj_path}")
+    xcodeproj_paths = find_xcodeprojs()
+    print(f"Xcodeプロジェクトを検出: {len(xcodeproj_paths)}件")
+    for xcodeproj_path in xcodeproj_paths:
+        print(f"  - {xcodeproj_path}")
     
-    # project.pbxproj ファイルのパス
-    pbxproj_path = xcodeproj_path / "project.pbxproj"
+    # 入力ファイルが変更されていなければキャッシュ済みの結果を使用
+    cache_dir = os.environ.get('BUNDLE_ID_CACHE_DIR')
+    cache_path = get_cache_path(cache_dir, xcodeproj_paths, environment) if cache_dir else None
+    cached = load_cached_bundle_ids(cache_path) if cache_path else None
     
-    if not pbxproj_path.exists():
-        print(f"エラー: {pbxproj_path} が見つかりません", file=sys.stderr)
-        sys.exit(1)
-    
-    # Bundle ID を抽出
-    bundle_ids = extract_bundle_id_from_pbxproj(pbxproj_path)
-    
-    # Bundle ID が見つからない場合は Info.plist から取得を試みる
-    if not bundle_ids:
-        print("project.pbxproj から Bundle ID が見つかりません。Info.plist を確認しています...")
-        bundle_ids = extract_bundle_id_from_plist(xcodeproj_path)
-    
-    if not bundle_ids:
-        print("エラー: Bundle ID が見つかりません", file=sys.stderr)
-        sys.exit(1)
+    if cached:
+        print(f"\nキャッシュを使用します（プロジェクトに変更なし）: {cache_path}")
+        bundle_ids = cached['bundle_ids']
+        sources = cached['sources']
+    else:
+        # すべてのプロジェクトから Bundle ID を並列に抽出
+        max_workers = os.environ.get('BUNDLE_ID_MAX_WORKERS')
+        bundle_ids, sources, inputs = extract_bundle_ids_from_projects(
+            xcodeproj_paths, max_workers=int(max_workers) if max_workers else None
+        )
+        
+        if not bundle_ids:
+            print("エラー: Bundle ID が見つかりません", file=sys.stderr)
+            sys.exit(1)
+        
+        # 出自を表示
+        print("\nBundle ID の出自:")
+        for bundle_id in bundle_ids:
+            for source in sources[bundle_id]:
+                print(f"  - {bundle_id}: {source['project']} "
+                      f"(ターゲット: {source['target'] or '不明'}, 構成: {source['configuration'] or '不明'})")
+        
+        # 環境に応じたサフィックスを適用
+        bundle_ids = apply_environment_suffix(bundle_ids, environment)
+        
+        if cache_path:
+            # 解析に使用したファイル（project.pbxproj / Info.plist / .xcconfig）・環境変数・
+            # 検索した Info.plist の一覧を入力として記録
+            save_cached_bundle_ids(cache_path, {
+                'inputs': {path: file_fingerprint(path) for path in inputs['files']},
+                'environ': inputs['environ'],
+                'info_plists': inputs['info_plists'],
+                'bundle_ids': bundle_ids,
+                'sources': sources
+            })
     
-    # 環境に応じたサフィックスを適用
-    bundle_ids = apply_environment_suffix(bundle_ids, environment)
+    # 出自を保存（後続のステップや調査用）
+    with open('/tmp/bundle_id_sources.json', 'w') as f:
+        json.dump(sources, f, indent=2, ensure_ascii=False)
     
     # 結果を出力
     print(f"\n検出された Bundle ID ({environment}環境):")
@@ -6,26 +6,40 @@ import os
 import sys
 import json
 import base64
+import threading
 import boto3
 from botocore.exceptions import ClientError
 
 
-def get_secret(secret_name, region_name):
-    """AWS Secrets Manager からシークレットを取得"""
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
+# (リージョン, プロファイル) → Secrets Manager クライアント（クライアントはスレッドセーフ）
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_secretsmanager_client(region_name, profile_name=None):
+    """Secrets Manager クライアントを返す（リージョン・プロファイルごとに1回だけ作成）"""
+    profile_name = profile_name or os.environ.get('AWS_PROFILE')
+    key = (region_name, profile_name)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            # Session はスレッドセーフではないため、ロック内で作成する
+            session = boto3.session.Session(profile_name=profile_name)
+            client = session.client(
+                service_name='secretsmanager',
+                region_name=region_name
+            )
+            _clients[key] = client
+        return client
+
+
+def fetch_secret(secret_name, region_name):
+    """AWS Secrets Manager からシークレットを取得（失敗時は ClientError を送出）"""
+    client = get_secretsmanager_client(region_name)
     
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name
-        )
-    except ClientError as e:
-        print(f"エラー: シークレット '{secret_name}' の取得に失敗しました", file=sys.stderr)
-        print(f"詳細: {e}", file=sys.stderr)
-        sys.exit(1)
+    get_secret_value_response = client.get_secret_value(
+        SecretId=secret_name
+    )
     
     # シークレットの値を取得
     if 'SecretString' in get_secret_value_response:
@@ -37,6 +51,16 @@ def get_secret(secret_name, region_name):
         return json.loads(decoded_binary_secret)
 
 
+def get_secret(secret_name, region_name):
+    """AWS Secrets Manager からシークレットを取得"""
+    try:
+        return fetch_secret(secret_name, region_name)
+    except ClientError as e:
+        print(f"エラー: シークレット '{secret_name}' の取得に失敗しました", file=sys.stderr)
+        print(f"詳細: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
 def save_p8_key(key_content, output_path):
     """P8形式の秘密鍵をファイルに保存"""
     with open(output_path, 'w') as f:
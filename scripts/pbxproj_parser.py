@@ -0,0 +1,340 @@
+"""
+project.pbxproj（OpenStep形式の plist）を解析するモジュール
+
+ファイルは mmap で読み込み、トークン単位で処理する。objects のうち
+ビルド設定の解決に必要なものだけを保持するため、巨大なプロジェクトでも
+メモリ使用量は抑えられる。
+"""
+import os
+import mmap
+import re
+
+
+# トークン（前後の空白・コメントは読み飛ばす）
+TOKEN_RE = re.compile(rb'''
+    (?:\s+|//[^\n]*|/\*.*?\*/)*
+    (?:
+        "(?P<quoted>(?:[^"\\]|\\.)*)"
+      | (?P<punct>[{}()=;,])
+      | (?P<word>[^\s{}()=;,"]+)
+      | (?P<end>\Z)
+    )
+''', re.S | re.X)
+
+ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', '"': '"', '\\': '\\', "'": "'"}
+
+# インデックスに保持する objects の isa
+INDEXED_ISA = {
+    'PBXProject',
+    'PBXNativeTarget',
+    'PBXAggregateTarget',
+    'PBXLegacyTarget',
+    'XCConfigurationList',
+    'XCBuildConfiguration',
+    'PBXFileReference',
+    'PBXGroup',
+    'PBXVariantGroup',
+}
+
+TARGET_ISA = {'PBXNativeTarget', 'PBXAggregateTarget', 'PBXLegacyTarget'}
+
+
+class PbxprojParseError(Exception):
+    """project.pbxproj の構文エラー"""
+
+
+def _unescape(value):
+    """クォートされた文字列のエスケープを解除"""
+    if '\\' not in value:
+        return value
+    return re.sub(r'\\(.)', lambda m: ESCAPES.get(m.group(1), m.group(1)), value)
+
+
+# objects のエントリの先頭（ID = {isa = XXX;）をまとめて読み取る
+_GAP = rb'(?:\s+|//[^\n]*|/\*.*?\*/)*'
+OBJECT_HEADER_RE = re.compile(
+    _GAP + rb'(?:"(?P<quoted_id>(?:[^"\\]|\\.)*)"|(?P<id>[^\s{}()=;,"]+))'
+    + _GAP + rb'=' + _GAP + rb'\{' + _GAP + rb'isa' + _GAP + rb'=' + _GAP
+    + rb'(?P<isa>[^\s{}()=;,"]+)' + _GAP + rb';',
+    re.S
+)
+
+# 読み飛ばし時に追跡する要素（括弧以外は文字列・コメントのみ）
+SKIP_RE = re.compile(rb'"(?:[^"\\]|\\.)*"|/\*.*?\*/|//[^\n]*|[{}()]', re.S)
+
+
+class _Lexer:
+    """バッファからトークン（種類, 値）を順に取り出す字句解析器"""
+    
+    def __init__(self, buffer):
+        self._buffer = buffer
+        self._pos = 0
+    
+    def next(self):
+        match = TOKEN_RE.match(self._buffer, self._pos)
+        if not match:
+            raise PbxprojParseError(f"不正な文字があります (offset {self._pos})")
+        self._pos = match.end()
+        
+        kind = match.lastgroup
+        if kind == 'punct':
+            return match.group(kind).decode('ascii'), None
+        if kind == 'quoted':
+            return 'string', _unescape(match.group(kind).decode('utf-8'))
+        if kind == 'word':
+            return 'string', match.group(kind).decode('utf-8')
+        raise PbxprojParseError("ファイルが途中で終了しています")
+    
+    def next_object_header(self):
+        """objects のエントリの先頭を読み取り（ID, isa）を返す（形式が異なる場合は None）"""
+        match = OBJECT_HEADER_RE.match(self._buffer, self._pos)
+        if not match:
+            return None
+        self._pos = match.end()
+        if match.group('quoted_id') is not None:
+            object_id = _unescape(match.group('quoted_id').decode('utf-8'))
+        else:
+            object_id = match.group('id').decode('utf-8')
+        return object_id, match.group('isa').decode('utf-8')
+    
+    def skip_block(self):
+        """開き括弧の直後から、対応する閉じ括弧までをトークン化せずに読み飛ばす"""
+        depth = 1
+        for match in SKIP_RE.finditer(self._buffer, self._pos):
+            char = match.group()
+            if char in (b'{', b'('):
+                depth += 1
+            elif char in (b'}', b')'):
+                depth -= 1
+                if depth == 0:
+                    self._pos = match.end()
+                    return
+        raise PbxprojParseError("ファイルが途中で終了しています")
+    
+    def release(self):
+        """バッファへの参照を解放"""
+        self._buffer = None
+
+
+class _Parser:
+    """トークン列を再帰下降で解析するパーサー"""
+    
+    def __init__(self, lexer):
+        self._lexer = lexer
+        self._peeked = None
+    
+    def _next(self):
+        if self._peeked is not None:
+            token, self._peeked = self._peeked, None
+            return token
+        return self._lexer.next()
+    
+    def _peek(self):
+        if self._peeked is None:
+            self._peeked = self._next()
+        return self._peeked
+    
+    def _expect(self, kind):
+        token = self._next()
+        if token[0] != kind:
+            raise PbxprojParseError(f"'{kind}' が必要ですが '{token[1] or token[0]}' がありました")
+        return token
+    
+    def parse_value(self):
+        kind, value = self._next()
+        if kind == 'string':
+            return value
+        if kind == '{':
+            return self._parse_dict_body()
+        if kind == '(':
+            return self._parse_array_body()
+        raise PbxprojParseError(f"値が必要ですが '{kind}' がありました")
+    
+    def _parse_dict_body(self):
+        result = {}
+        while True:
+            kind, key = self._next()
+            if kind == '}':
+                return result
+            if kind != 'string':
+                raise PbxprojParseError(f"キーが必要ですが '{kind}' がありました")
+            self._expect('=')
+            result[key] = self.parse_value()
+            self._expect(';')
+    
+    def _parse_array_body(self):
+        result = []
+        while True:
+            if self._peek()[0] == ')':
+                self._next()
+                return result
+            result.append(self.parse_value())
+            if self._peek()[0] == ',':
+                self._next()
+    
+    def _parse_object(self, keep_isa):
+        """objects のエントリを解析（isa が対象外なら構築せずに読み飛ばす）"""
+        kind = self._next()[0]
+        if kind != '{':
+            if kind == '(':
+                self._lexer.skip_block()
+            return None
+        
+        # isa は通常先頭にあるため、先読みして対象外なら読み飛ばす
+        first = self._next()
+        if first == ('string', 'isa'):
+            self._expect('=')
+            isa = self._expect('string')[1]
+            self._expect(';')
+            if not keep_isa(isa):
+                self._lexer.skip_block()
+                return None
+            result = self._parse_dict_body()
+            result['isa'] = isa
+            return result
+        
+        self._peeked = first
+        result = self._parse_dict_body()
+        return result if keep_isa(result.get('isa')) else None
+    
+    def parse_project(self, keep_isa):
+        """トップレベルを解析し、objects は keep_isa が True のものだけ保持"""
+        self._expect('{')
+        root = {}
+        while True:
+            kind, key = self._next()
+            if kind == '}':
+                return root
+            self._expect('=')
+            
+            if key == 'objects':
+                objects = {}
+                self._expect('{')
+                while True:
+                    # 一般的な形式のエントリは先頭を一括で読み取り、対象外なら読み飛ばす
+                    header = self._lexer.next_object_header()
+                    if header is not None:
+                        object_id, isa = header
+                        if keep_isa(isa):
+                            obj = self._parse_dict_body()
+                            obj['isa'] = isa
+                            objects[object_id] = obj
+                        else:
+                            self._lexer.skip_block()
+                        self._expect(';')
+                        continue
+                    
+                    kind, object_id = self._next()
+                    if kind == '}':
+                        break
+                    self._expect('=')
+                    obj = self._parse_object(keep_isa)
+                    if obj is not None:
+                        objects[object_id] = obj
+                    self._expect(';')
+                root['objects'] = objects
+            else:
+                root[key] = self.parse_value()
+            self._expect(';')
+
+
+def parse_pbxproj(pbxproj_path, isa_filter=INDEXED_ISA):
+    """project.pbxproj を mmap で読み込んで解析（isa_filter の objects のみ保持）"""
+    with open(pbxproj_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise PbxprojParseError(f"{pbxproj_path} が空です")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            lexer = _Lexer(buffer)
+            try:
+                return _Parser(lexer).parse_project(lambda isa: isa in isa_filter)
+            finally:
+                # mmap を閉じる前にバッファへの参照を解放
+                lexer.release()
+
+
+class BuildConfigurationIndex:
+    """ターゲット・ビルド構成ごとの XCBuildConfiguration の索引"""
+    
+    def __init__(self, project):
+        self.objects = project.get('objects', {})
+        root = self.objects.get(project.get('rootObject'), {})
+        self.project_dir_path = root.get('projectDirPath', '')
+        self.main_group = root.get('mainGroup')
+        self._parents = None
+        
+        # プロジェクトレベルの構成（ターゲット設定の既定値）
+        self.project_configurations = self._configurations(root.get('buildConfigurationList'))
+        
+        # ターゲット名 → {構成名: XCBuildConfiguration}
+        self.targets = {}
+        target_ids = root.get('targets') or [
+            object_id for object_id, obj in self.objects.items() if obj.get('isa') in TARGET_ISA
+        ]
+        for target_id in target_ids:
+            target = self.objects.get(target_id, {})
+            if target.get('isa') in TARGET_ISA:
+                self.targets[target.get('name', target_id)] = self._configurations(
+                    target.get('buildConfigurationList')
+                )
+    
+    def _configurations(self, configuration_list_id):
+        configuration_list = self.objects.get(configuration_list_id, {})
+        configurations = {}
+        for configuration_id in configuration_list.get('buildConfigurations', []):
+            configuration = self.objects.get(configuration_id)
+            if configuration:
+                configurations[configuration.get('name', configuration_id)] = configuration
+        return configurations
+    
+    def file_reference_path(self, file_ref_id, source_root):
+        """PBXFileReference のパスを、グループ階層をたどって解決"""
+        parents = self._group_parents()
+        current_id = file_ref_id
+        parts = []
+        
+        while current_id in self.objects:
+            obj = self.objects[current_id]
+            source_tree = obj.get('sourceTree', '<group>')
+            if obj.get('path'):
+                parts.append(obj['path'])
+            if source_tree == '<absolute>':
+                return os.path.normpath(os.path.join(*reversed(parts))) if parts else None
+            if source_tree == 'SOURCE_ROOT':
+                break
+            if source_tree != '<group>':
+                # BUILT_PRODUCTS_DIR などビルド時に決まる場所は解決しない
+                return None
+            current_id = parents.get(current_id)
+        
+        base = os.path.join(source_root, self.project_dir_path)
+        return os.path.normpath(os.path.join(base, *reversed(parts)))
+    
+    def _group_parents(self):
+        """子要素のID → 親グループのID"""
+        if self._parents is None:
+            self._parents = {}
+            for object_id, obj in self.objects.items():
+                if obj.get('isa') in ('PBXGroup', 'PBXVariantGroup'):
+                    for child_id in obj.get('children', []):
+                        self._parents[child_id] = object_id
+        return self._parents
+    
+    def iter_configurations(self, configuration_names=None):
+        """（ターゲット名, 構成名, XCBuildConfiguration）を返す
+        
+        ターゲットを持たないプロジェクトレベルの構成はターゲット名を None とする。
+        configuration_names を指定した場合はその構成のみ返す。
+        """
+        for name, configuration in self.project_configurations.items():
+            if configuration_names is None or name in configuration_names:
+                yield None, name, configuration
+        
+        for target_name, configurations in self.targets.items():
+            for name, configuration in configurations.items():
+                if configuration_names is None or name in configuration_names:
+                    yield target_name, name, configuration
+
+
+def load_build_configuration_index(pbxproj_path):
+    """project.pbxproj からビルド構成の索引を作成"""
+    return BuildConfigurationIndex(parse_pbxproj(pbxproj_path))
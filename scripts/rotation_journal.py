@@ -0,0 +1,188 @@
+"""
+証明書ローテーションの進捗を記録するジャーナル
+
+無効化・証明書の作成・Bundle ID ごとのプロファイル再作成・アップロードの
+各ステップが完了するたびに記録し、リトライ時は完了済みのステップを
+飛ばして再開できるようにする。リトライは別のランナーで実行されるため、
+ローカルファイルに加えて AWS Secrets Manager にも保存する。
+プロファイルごとの記録は毎回ローカルに保存し、シークレットへは一定の件数または
+時間ごとにまとめて書き込む（シークレットのバージョンを Bundle ID の数だけ
+増やさずに、ジョブが強制終了されても大半の記録を残す）。
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+from datetime import datetime, timezone
+from botocore.exceptions import ClientError
+from get_api_credentials import fetch_secret, get_secretsmanager_client
+
+
+# ローカルのジャーナルファイル
+JOURNAL_PATH = os.environ.get('ROTATION_JOURNAL_PATH', '/tmp/rotation_journal.json')
+# プロファイルの記録をシークレットに保存する間隔（件数・秒）
+FLUSH_BATCH_SIZE = int(os.environ.get('ROTATION_JOURNAL_FLUSH_BATCH', '5'))
+FLUSH_INTERVAL = float(os.environ.get('ROTATION_JOURNAL_FLUSH_INTERVAL', '30'))
+
+
+def journal_secret_name(environment=None):
+    """ジャーナルを保存するシークレット名（ROTATION_JOURNAL_SECRET が空の場合は保存しない）"""
+    if 'ROTATION_JOURNAL_SECRET' in os.environ:
+        return os.environ['ROTATION_JOURNAL_SECRET'] or None
+    
+    environment = environment or os.environ.get('ENVIRONMENT', 'main')
+    env_suffix = 'prd' if environment == 'main' else environment
+    secret_base_name = os.environ.get('CERTIFICATE_SECRET_BASE_NAME', 'apple-certificate-update')
+    return f"{secret_base_name}/rotation-journal-{env_suffix}"
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class RotationJournal:
+    """ローテーションの各ステップの完了状態と成果物を保持する（スレッドセーフ）"""
+    
+    def __init__(self, data, path=JOURNAL_PATH, secret_name=None, region_name=None):
+        self.data = data
+        self.path = path
+        self.secret_name = secret_name
+        self.region_name = region_name or os.environ.get('AWS_REGION', 'ap-northeast-1')
+        self._lock = threading.Lock()
+        # 保存（ファイル・シークレットへの書き込み）を直列化するためのロック
+        self._save_lock = threading.Lock()
+        # シークレットに保存していないプロファイルの記録の件数と、最後に保存した時刻
+        self._unflushed = 0
+        self._flushed_at = time.monotonic()
+    
+    @classmethod
+    def start(cls, outgoing_certificate_id, bundle_ids, path=JOURNAL_PATH, secret_name=None,
+              region_name=None):
+        """新しいローテーションのジャーナルを作成して保存"""
+        data = {
+            'run_id': os.environ.get('GITHUB_RUN_ID'),
+            'started_at': _now(),
+            'outgoing_certificate_id': outgoing_certificate_id,
+            'bundle_ids': bundle_ids,
+            'steps': {},
+            'profiles': {},
+        }
+        journal = cls(data, path, secret_name, region_name)
+        journal.save()
+        return journal
+    
+    @classmethod
+    def load(cls, path=JOURNAL_PATH, secret_name=None, region_name=None):
+        """保存済みのジャーナルを読み込む（ローカル → シークレットの順、なければ None）
+        
+        GITHUB_RUN_ID が異なる（別のワークフロー実行の）ジャーナルは使用しない。
+        """
+        data = None
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    data = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"警告: ジャーナル {path} を読み込めませんでした: {e}", file=sys.stderr)
+        
+        if data is None and secret_name:
+            try:
+                data = fetch_secret(secret_name, region_name or os.environ.get('AWS_REGION', 'ap-northeast-1'))
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ResourceNotFoundException':
+                    print(f"警告: ジャーナル '{secret_name}' を取得できませんでした: {e}", file=sys.stderr)
+        
+        if not data:
+            return None
+        
+        run_id = os.environ.get('GITHUB_RUN_ID')
+        if run_id and data.get('run_id') and data['run_id'] != run_id:
+            print(f"ジャーナルは別の実行（{data['run_id']}）のものです。使用しません")
+            return None
+        
+        return cls(data, path, secret_name, region_name)
+    
+    @property
+    def outgoing_certificate_id(self):
+        return self.data.get('outgoing_certificate_id')
+    
+    @property
+    def bundle_ids(self):
+        return self.data.get('bundle_ids') or []
+    
+    def get(self, step):
+        """完了済みのステップの記録を返す（未完了なら None）"""
+        with self._lock:
+            return self.data['steps'].get(step)
+    
+    def record(self, step, **values):
+        """ステップの完了を記録して保存"""
+        with self._lock:
+            self.data['steps'][step] = dict(values, completed_at=_now())
+        self.save()
+    
+    def profile(self, bundle_id):
+        """再作成済みのプロファイルの記録を返す（未完了なら None）"""
+        with self._lock:
+            return self.data['profiles'].get(bundle_id)
+    
+    def record_profile(self, bundle_id, **values):
+        """プロファイルの再作成の完了を記録して保存
+        
+        ローカルには毎回保存し、シークレットへは FLUSH_BATCH_SIZE 件ごと、または
+        前回の保存から FLUSH_INTERVAL 秒以上経過した場合に保存する。
+        """
+        with self._lock:
+            self.data['profiles'][bundle_id] = dict(values, completed_at=_now())
+            self._unflushed += 1
+            remote = (self._unflushed >= FLUSH_BATCH_SIZE
+                      or time.monotonic() - self._flushed_at >= FLUSH_INTERVAL)
+        self.save(remote=remote)
+    
+    def flush(self):
+        """シークレットに保存していない記録があれば保存"""
+        with self._lock:
+            unflushed = self._unflushed
+        if unflushed:
+            self.save()
+    
+    def save(self, remote=True):
+        """ローカルファイルとシークレットに保存（P12 を含むためファイルは 0600）
+        
+        記録中のスレッドを待たせないよう、内容のスナップショットだけをロック中に
+        取得し、書き込みはロックの外で行う。
+        """
+        with self._save_lock:
+            with self._lock:
+                body = json.dumps(self.data, indent=2)
+                if remote or not self.secret_name:
+                    self._unflushed = 0
+                    self._flushed_at = time.monotonic()
+            
+            directory = os.path.dirname(self.path) or '.'
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                f.write(body)
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self.path)
+            
+            if remote and self.secret_name:
+                self._save_secret(body)
+    
+    def _save_secret(self, body):
+        """シークレットに保存（失敗してもローカルの記録は残す）"""
+        client = get_secretsmanager_client(self.region_name)
+        
+        try:
+            client.update_secret(SecretId=self.secret_name, SecretString=body)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ResourceNotFoundException':
+                print(f"警告: ジャーナルをシークレットに保存できませんでした: {e}", file=sys.stderr)
+                return
+            try:
+                client.create_secret(Name=self.secret_name, SecretString=body)
+            except ClientError as create_error:
+                print(f"警告: ジャーナルのシークレットを作成できませんでした: {create_error}", file=sys.stderr)
@@ -5,9 +5,34 @@ Apple Distribution証明書を更新するスクリプト
 import os
 import sys
 import json
-import subprocess
-import tempfile
+import base64
+import time
+import secrets
+import argparse
+import requests
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.serialization import pkcs12
+from check_certificate_expiry import (
+    AppStoreConnectAPI, DISTRIBUTION_CERTIFICATE_TYPE, APP_STORE_PROFILE_TYPE
+)
+from rotation_journal import RotationJournal, journal_secret_name
+from command_runner import run_command, command_history
+from upload_to_secrets_manager import read_file_as_base64
+
+
+# プロファイル出力先のルート（Bundle ID ごとにサブディレクトリを作成）
+PROFILES_OUTPUT_DIR = '/tmp/profiles'
+# プロファイル更新の同時実行数
+PROFILE_MAX_WORKERS = int(os.environ.get('PROFILE_MAX_WORKERS', '4'))
+# true の場合は無効化する証明書を参照していないプロファイルも含めてすべて再作成
+FORCE_PROFILE_REGENERATION = os.environ.get('FORCE_PROFILE_REGENERATION', 'false').lower() == 'true'
+# Fastlane の各コマンドのタイムアウト（秒）
+FASTLANE_TIMEOUT = float(os.environ.get('FASTLANE_TIMEOUT', '600'))
 
 
 def load_certificate_info():
@@ -19,53 +44,99 @@ def load_certificate_info():
     return {}
 
 
+def create_api_client():
+    """環境変数の認証情報から App Store Connect API クライアントを作成"""
+    key_id = os.environ.get('APP_STORE_CONNECT_KEY_ID')
+    issuer_id = os.environ.get('APP_STORE_CONNECT_ISSUER_ID')
+    key_path = os.environ.get('APP_STORE_CONNECT_KEY_PATH', '/tmp/AuthKey.p8')
+    
+    if not all([key_id, issuer_id, key_path]):
+        print("エラー: API認証情報が設定されていません", file=sys.stderr)
+        sys.exit(1)
+    
+    # ローテーションは最新の証明書・プロファイルの対応に基づく必要があるため、
+    # 期限チェック用のレスポンスキャッシュは読まない。無効化・作成・削除の後に
+    # 期限チェックが古い一覧を読まないよう、書き込み時のキャッシュの破棄は行う
+    return AppStoreConnectAPI(key_id, issuer_id, key_path, bypass_cache=True)
+
+
 def create_certificate_signing_request():
-    """証明書署名要求（CSR）を作成"""
+    """証明書署名要求（CSR）と秘密鍵を作成"""
     print("証明書署名要求（CSR）を作成しています...")
     
-    # 一時ディレクトリを作成
-    temp_dir = tempfile.mkdtemp()
-    private_key_path = os.path.join(temp_dir, 'private_key.p12')
-    csr_path = os.path.join(temp_dir, 'CertificateSigningRequest.certSigningRequest')
+    # Apple の証明書は RSA 2048bit の鍵が必要
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
     
-    # CSRを作成するためのFastlaneコマンド
-    # 注: 実際の実装ではApp Store Connect APIを直接使用することも可能
-    cmd = [
-        'fastlane', 'cert',
-        '--username', os.environ.get('APPLE_ID', ''),
-        '--team_id', os.environ.get('TEAM_ID', ''),
-        '--output_path', temp_dir,
-        '--keychain_path', 'login.keychain',
-        '--skip_install',
-        '--platform', 'ios'
+    attributes = [
+        x509.NameAttribute(NameOID.COMMON_NAME, os.environ.get('CERTIFICATE_COMMON_NAME', 'Apple Distribution'))
     ]
+    if os.environ.get('APPLE_ID'):
+        attributes.append(x509.NameAttribute(NameOID.EMAIL_ADDRESS, os.environ['APPLE_ID']))
+    
+    csr = x509.CertificateSigningRequestBuilder().subject_name(
+        x509.Name(attributes)
+    ).sign(private_key, hashes.SHA256())
     
-    # API Key認証を使用
+    print("CSRの作成に成功しました")
+    return csr.public_bytes(serialization.Encoding.PEM).decode('utf-8'), private_key
+
+
+def build_p12(private_key, certificate, password, name):
+    """秘密鍵と証明書から P12 ファイルの内容を作成"""
+    try:
+        # キーチェーン（macOS の security コマンド）で読み込める形式で暗号化
+        encryption = (
+            serialization.PrivateFormat.PKCS12.encryption_builder()
+            .kdf_rounds(50000)
+            .key_cert_algorithm(pkcs12.PBES.PBESv1SHA1And3KeyTripleDESCBC)
+            .hmac_hash(hashes.SHA1())
+            .build(password.encode('utf-8'))
+        )
+    except AttributeError:
+        # 古い cryptography の場合
+        encryption = serialization.BestAvailableEncryption(password.encode('utf-8'))
+    
+    return pkcs12.serialize_key_and_certificates(
+        name=name.encode('utf-8'),
+        key=private_key,
+        cert=certificate,
+        cas=None,
+        encryption_algorithm=encryption
+    )
+
+
+def fastlane_env():
+    """Fastlane 用の環境変数（API Key の設定とカラー出力の無効化）"""
     env = os.environ.copy()
     env['APP_STORE_CONNECT_API_KEY_KEY_ID'] = os.environ.get('APP_STORE_CONNECT_KEY_ID', '')
     env['APP_STORE_CONNECT_API_KEY_ISSUER_ID'] = os.environ.get('APP_STORE_CONNECT_ISSUER_ID', '')
     env['APP_STORE_CONNECT_API_KEY_KEY_FILEPATH'] = os.environ.get('APP_STORE_CONNECT_KEY_PATH', '')
-    
-    try:
-        result = subprocess.run(cmd, env=env, capture_output=True, text=True)
-        if result.returncode != 0:
-            print(f"エラー: CSRの作成に失敗しました")
-            print(f"標準出力: {result.stdout}")
-            print(f"標準エラー: {result.stderr}")
-            return None, None
-            
-        print("CSRの作成に成功しました")
-        return csr_path, private_key_path
-        
-    except Exception as e:
-        print(f"エラー: {e}")
-        return None, None
+    env['FASTLANE_DISABLE_COLORS'] = '1'  # カラー出力を無効化
+    return env
 
 
-def revoke_old_certificate(certificate_id):
-    """古い証明書を無効化"""
+def revoke_old_certificate(certificate_id, api=None):
+    """古い証明書を無効化（成功した場合は True）
+    
+    api を指定した場合は App Store Connect API で無効化し、
+    指定しない場合は従来どおり Fastlane を使用する。
+    """
     print(f"古い証明書を無効化しています: {certificate_id}")
     
+    if api is not None:
+        try:
+            api.revoke_certificate(certificate_id)
+        except requests.HTTPError as e:
+            # 無効化済み（リトライ時など）の場合は完了として扱う
+            if e.response is None or e.response.status_code != 404:
+                print(f"警告: 古い証明書の無効化に失敗しました（処理は継続します）: {e}")
+                return False
+        except requests.RequestException as e:
+            print(f"警告: 証明書の無効化中にエラーが発生しました: {e}")
+            return False
+        print("古い証明書の無効化に成功しました")
+        return True
+    
     # Fastlaneを使用して証明書を無効化
     cmd = [
         'fastlane', 'run', 'revoke_certificate',
@@ -73,24 +144,68 @@ def revoke_old_certificate(certificate_id):
         '--verbose'
     ]
     
-    env = os.environ.copy()
-    env['APP_STORE_CONNECT_API_KEY_KEY_ID'] = os.environ.get('APP_STORE_CONNECT_KEY_ID', '')
-    env['APP_STORE_CONNECT_API_KEY_ISSUER_ID'] = os.environ.get('APP_STORE_CONNECT_ISSUER_ID', '')
-    env['APP_STORE_CONNECT_API_KEY_KEY_FILEPATH'] = os.environ.get('APP_STORE_CONNECT_KEY_PATH', '')
-    
     try:
-        result = subprocess.run(cmd, env=env, capture_output=True, text=True)
-        if result.returncode == 0:
+        result = run_command(cmd, env=fastlane_env(), timeout=FASTLANE_TIMEOUT, label='revoke_certificate')
+        if result.ok:
             print("古い証明書の無効化に成功しました")
+            return True
         else:
             print(f"警告: 古い証明書の無効化に失敗しました（処理は継続します）")
-            print(f"エラー: {result.stderr}")
     except Exception as e:
         print(f"警告: 証明書の無効化中にエラーが発生しました: {e}")
+    return False
+
+
+def create_new_certificate_via_api(api):
+    """App Store Connect API で新しい証明書を作成し、.cer と .p12 を出力"""
+    print("\n新しいDistribution証明書を作成しています...")
+    
+    # 出力ディレクトリ
+    output_dir = '/tmp/certificates'
+    os.makedirs(output_dir, exist_ok=True)
+    
+    try:
+        csr_pem, private_key = create_certificate_signing_request()
+        response = api.create_certificate(csr_pem, DISTRIBUTION_CERTIFICATE_TYPE)
+        
+        certificate_id = response['data']['id']
+        cert_der = base64.b64decode(response['data']['attributes']['certificateContent'])
+        certificate = x509.load_der_x509_certificate(cert_der)
+        
+        cert_path = os.path.join(output_dir, f"{certificate_id}.cer")
+        with open(cert_path, 'wb') as f:
+            f.write(cert_der)
+        
+        # P12 のパスワード（未指定の場合は生成して結果に含める）
+        p12_password = os.environ.get('P12_PASSWORD') or secrets.token_urlsafe(24)
+        p12_path = os.path.join(output_dir, f"{certificate_id}.p12")
+        with open(p12_path, 'wb') as f:
+            f.write(build_p12(private_key, certificate, p12_password, certificate_id))
+        os.chmod(p12_path, 0o600)
+        
+        print(f"証明書の作成に成功しました")
+        print(f"  証明書ID: {certificate_id}")
+        print(f"  証明書: {cert_path}")
+        print(f"  P12ファイル: {p12_path}")
+        
+        return {
+            'certificate_id': certificate_id,
+            'certificate_path': cert_path,
+            'p12_path': p12_path,
+            'p12_password': p12_password,
+            'output_dir': output_dir
+        }
+        
+    except Exception as e:
+        print(f"エラー: 証明書の作成に失敗しました: {e}")
+        return None
 
 
-def create_new_certificate():
-    """新しい証明書を作成"""
+def create_new_certificate(api=None):
+    """新しい証明書を作成（api を指定しない場合は Fastlane を使用）"""
+    if api is not None:
+        return create_new_certificate_via_api(api)
+    
     print("\n新しいDistribution証明書を作成しています...")
     
     # 出力ディレクトリ
@@ -107,18 +222,11 @@ def create_new_certificate():
         '--force'  # 既存の証明書があっても新規作成
     ]
     
-    env = os.environ.copy()
-    env['APP_STORE_CONNECT_API_KEY_KEY_ID'] = os.environ.get('APP_STORE_CONNECT_KEY_ID', '')
-    env['APP_STORE_CONNECT_API_KEY_ISSUER_ID'] = os.environ.get('APP_STORE_CONNECT_ISSUER_ID', '')
-    env['APP_STORE_CONNECT_API_KEY_KEY_FILEPATH'] = os.environ.get('APP_STORE_CONNECT_KEY_PATH', '')
-    env['FASTLANE_DISABLE_COLORS'] = '1'  # カラー出力を無効化
-    
     try:
-        result = subprocess.run(cmd, env=env, capture_output=True, text=True)
-        if result.returncode != 0:
+        # 出力は実行中に逐次ログへ流れる
+        result = run_command(cmd, env=fastlane_env(), timeout=FASTLANE_TIMEOUT, label='cert')
+        if not result.ok:
             print(f"エラー: 証明書の作成に失敗しました")
-            print(f"標準出力: {result.stdout}")
-            print(f"標準エラー: {result.stderr}")
             return None
             
         # 作成された証明書ファイルを探す
@@ -144,12 +252,18 @@ def create_new_certificate():
         return None
 
 
-def update_provisioning_profiles(bundle_id):
+def profile_output_dir(bundle_id, output_root=PROFILES_OUTPUT_DIR):
+    """Bundle ID ごとのプロファイル出力ディレクトリ（並列実行時に結果が混ざらないよう分離）"""
+    output_dir = os.path.join(output_root, bundle_id)
+    os.makedirs(output_dir, exist_ok=True)
+    return output_dir
+
+
+def update_provisioning_profiles(bundle_id, output_root=PROFILES_OUTPUT_DIR, journal=None):
     """プロビジョニングプロファイルを更新"""
     print(f"\nBundle ID '{bundle_id}' のプロビジョニングプロファイルを更新しています...")
     
-    output_dir = '/tmp/profiles'
-    os.makedirs(output_dir, exist_ok=True)
+    output_dir = profile_output_dir(bundle_id, output_root)
     
     # Fastlaneでプロファイルを更新
     cmd = [
@@ -163,25 +277,21 @@ def update_provisioning_profiles(bundle_id):
         '--development', 'false'  # Distribution用
     ]
     
-    env = os.environ.copy()
-    env['APP_STORE_CONNECT_API_KEY_KEY_ID'] = os.environ.get('APP_STORE_CONNECT_KEY_ID', '')
-    env['APP_STORE_CONNECT_API_KEY_ISSUER_ID'] = os.environ.get('APP_STORE_CONNECT_ISSUER_ID', '')
-    env['APP_STORE_CONNECT_API_KEY_KEY_FILEPATH'] = os.environ.get('APP_STORE_CONNECT_KEY_PATH', '')
-    env['FASTLANE_DISABLE_COLORS'] = '1'
-    
     try:
-        result = subprocess.run(cmd, env=env, capture_output=True, text=True)
-        if result.returncode != 0:
-            print(f"警告: プロビジョニングプロファイルの更新に失敗しました")
-            print(f"エラー: {result.stderr}")
+        # 並列実行時も行ごとに Bundle ID のラベルが付く
+        result = run_command(cmd, env=fastlane_env(), timeout=FASTLANE_TIMEOUT, label=f'sigh {bundle_id}')
+        if not result.ok:
+            print(f"警告: プロビジョニングプロファイルの更新に失敗しました ({bundle_id})")
             return None
             
         # 作成されたプロファイルを探す
         profile_files = list(Path(output_dir).glob('*.mobileprovision'))
         
         if profile_files:
-            print(f"プロビジョニングプロファイルの更新に成功しました")
+            print(f"プロビジョニングプロファイルの更新に成功しました: {bundle_id}")
             print(f"  プロファイル: {profile_files[0]}")
+            if journal is not None:
+                journal.record_profile(bundle_id, path=str(profile_files[0]))
             return str(profile_files[0])
         else:
             print("警告: プロビジョニングプロファイルファイルが見つかりません")
@@ -192,25 +302,257 @@ def update_provisioning_profiles(bundle_id):
         return None
 
 
+def profile_file_name(bundle_id):
+    """プロファイルのファイル名（upload_to_secrets_manager.py が Bundle ID を復元できる形式）"""
+    return f"{bundle_id.replace('.', '_')}.mobileprovision"
+
+
+def run_profile_updates(update_func, bundle_ids, max_workers=PROFILE_MAX_WORKERS):
+    """Bundle ID ごとのプロファイル更新を並列に実行し、Bundle ID → パスを返す
+    
+    update_func は Bundle ID を受け取り、プロファイルのパス（失敗時は None）を返す。
+    結果は bundle_ids の順に並び、失敗したものは含まない。
+    """
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(bundle_ids)))) as executor:
+        paths = list(executor.map(update_func, bundle_ids))
+    
+    return {bundle_id: path for bundle_id, path in zip(bundle_ids, paths) if path}
+
+
+def regenerate_profile_via_api(api, bundle_id, resource_id, old_profile_ids, certificate_id,
+                               output_root=PROFILES_OUTPUT_DIR, journal=None):
+    """1つの Bundle ID の App Store 用プロファイルを再作成（失敗時は None）"""
+    print(f"\nBundle ID '{bundle_id}' のプロビジョニングプロファイルを更新しています...")
+    
+    if not resource_id:
+        print(f"警告: Bundle ID '{bundle_id}' が App Store Connect に登録されていません")
+        return None
+    
+    try:
+        for profile_id in old_profile_ids:
+            try:
+                api.delete_profile(profile_id)
+            except requests.HTTPError as e:
+                # リトライ時は前回の実行で削除済みの場合がある
+                if e.response is None or e.response.status_code != 404:
+                    raise
+            print(f"  既存のプロファイルを削除しました: {profile_id}")
+        
+        response = api.create_profile(
+            f"{bundle_id} AppStore {int(time.time())}",
+            resource_id,
+            [certificate_id],
+            APP_STORE_PROFILE_TYPE
+        )
+        profile_content = base64.b64decode(response['data']['attributes']['profileContent'])
+        
+        profile_path = os.path.join(profile_output_dir(bundle_id, output_root), profile_file_name(bundle_id))
+        with open(profile_path, 'wb') as f:
+            f.write(profile_content)
+        
+        if journal is not None:
+            journal.record_profile(bundle_id, profile_id=response['data']['id'], path=profile_path)
+        
+        print(f"プロビジョニングプロファイルの更新に成功しました: {bundle_id}")
+        print(f"  プロファイル: {profile_path}")
+        return profile_path
+        
+    except Exception as e:
+        print(f"警告: プロビジョニングプロファイルの更新中にエラーが発生しました ({bundle_id}): {e}")
+        return None
+
+
+def plan_profile_rotation(api, bundle_ids, outgoing_certificate_id):
+    """無効化する証明書を参照しているプロファイルだけを再作成対象として選ぶ
+    
+    証明書の無効化で影響を受けるのは、その証明書を含むプロファイルのみのため、
+    それ以外のプロファイルは残す。プロファイルが存在しない Bundle ID は作成対象とする。
+    （再作成する Bundle ID, 変更しない Bundle ID, Bundle ID → 削除するプロファイルID）を返す。
+    取得に失敗した場合は None を返す。
+    """
+    try:
+        profiles = api.get_profile_certificates_by_bundle_id(APP_STORE_PROFILE_TYPE)
+    except Exception as e:
+        print(f"警告: プロファイルと証明書の対応の取得に失敗しました: {e}")
+        return None
+    
+    targets = []
+    unchanged = []
+    profiles_to_delete = {}
+    for bundle_id in bundle_ids:
+        bundle_profiles = profiles.get(bundle_id, {})
+        affected = [
+            profile_id for profile_id, certificate_ids in bundle_profiles.items()
+            if outgoing_certificate_id in certificate_ids
+        ]
+        if affected or not bundle_profiles:
+            targets.append(bundle_id)
+            profiles_to_delete[bundle_id] = affected
+        else:
+            unchanged.append(bundle_id)
+    
+    print(f"\nプロファイルの再作成対象: {len(targets)} 件（変更なし: {len(unchanged)} 件）")
+    for bundle_id in unchanged:
+        print(f"  変更なし: {bundle_id}（証明書 {outgoing_certificate_id} を参照していません）")
+    
+    return targets, unchanged, profiles_to_delete
+
+
+def regenerate_profiles_via_api(api, bundle_ids, certificate_id, output_root=PROFILES_OUTPUT_DIR,
+                                profiles_to_delete=None, journal=None):
+    """App Store Connect API で App Store 用プロファイルを一括で再作成
+    
+    Bundle ID リソースと既存プロファイルはまとめて取得し、Bundle ID ごとの
+    削除・作成・保存は並列に実行する（認証と接続はクライアントで共有）。
+    profiles_to_delete（Bundle ID → プロファイルID）を指定した場合は、
+    既存プロファイルを取得せずにそのプロファイルのみ削除する。
+    Bundle ID → プロファイルのパスを返す（失敗したものは含まない）。
+    """
+    print(f"\n{len(bundle_ids)} 件のプロビジョニングプロファイルを更新しています...")
+    
+    try:
+        bundle_id_resources = api.get_bundle_id_resources(bundle_ids)
+        if profiles_to_delete is None:
+            # 既存のプロファイルはすべて削除する（Bundle ID → プロファイルIDの一覧）
+            profiles = api.get_profile_certificates_by_bundle_id(APP_STORE_PROFILE_TYPE)
+            profiles_to_delete = {bundle_id: list(bundle_profiles) for bundle_id, bundle_profiles in profiles.items()}
+    except Exception as e:
+        print(f"警告: Bundle ID またはプロファイルの取得に失敗しました: {e}")
+        return {}
+    
+    return run_profile_updates(
+        lambda bundle_id: regenerate_profile_via_api(
+            api,
+            bundle_id,
+            bundle_id_resources.get(bundle_id),
+            profiles_to_delete.get(bundle_id, []),
+            certificate_id,
+            output_root,
+            journal
+        ),
+        bundle_ids
+    )
+
+
+def record_certificate(journal, cert_info):
+    """作成した証明書と P12 をジャーナルに記録（別のランナーでのリトライでも復元できるよう内容ごと保存）"""
+    journal.record(
+        'create',
+        certificate_id=cert_info.get('certificate_id'),
+        certificate=read_file_as_base64(cert_info['certificate_path']),
+        p12=read_file_as_base64(cert_info['p12_path']),
+        p12_password=cert_info.get('p12_password')
+    )
+
+
+def restore_certificate(entry, output_dir='/tmp/certificates'):
+    """ジャーナルに記録された証明書と P12 をファイルに書き戻す"""
+    os.makedirs(output_dir, exist_ok=True)
+    name = entry.get('certificate_id') or 'distribution'
+    
+    cert_path = os.path.join(output_dir, f"{name}.cer")
+    with open(cert_path, 'wb') as f:
+        f.write(base64.b64decode(entry['certificate']))
+    
+    p12_path = os.path.join(output_dir, f"{name}.p12")
+    with open(p12_path, 'wb') as f:
+        f.write(base64.b64decode(entry['p12']))
+    os.chmod(p12_path, 0o600)
+    
+    print(f"作成済みの証明書を再利用します: {entry.get('certificate_id') or cert_path}")
+    return {
+        'certificate_id': entry.get('certificate_id'),
+        'certificate_path': cert_path,
+        'p12_path': p12_path,
+        'p12_password': entry.get('p12_password'),
+        'output_dir': output_dir
+    }
+
+
+def restore_profiles(journal, api, bundle_ids, output_root=PROFILES_OUTPUT_DIR):
+    """ジャーナルに記録済みのプロファイルを復元し、Bundle ID → パスを返す
+    
+    同じランナーではファイルをそのまま使い、別のランナーでは記録した
+    プロファイルIDから内容を取得し直す（再作成はしない）。
+    """
+    restored = {}
+    for bundle_id in bundle_ids:
+        entry = journal.profile(bundle_id)
+        if not entry:
+            continue
+        
+        path = entry.get('path')
+        if not (path and os.path.exists(path)):
+            if not entry.get('profile_id') or api is None:
+                continue
+            try:
+                content = api.get_profile_content(entry['profile_id'])
+            except Exception as e:
+                print(f"警告: 作成済みのプロファイルを取得できませんでした ({bundle_id}): {e}")
+                continue
+            path = os.path.join(profile_output_dir(bundle_id, output_root), profile_file_name(bundle_id))
+            with open(path, 'wb') as f:
+                f.write(content)
+        
+        print(f"作成済みのプロファイルを再利用します: {bundle_id}")
+        restored[bundle_id] = path
+    return restored
+
+
+def adopt_existing_profiles(journal, api, bundle_ids, certificate_id, output_root=PROFILES_OUTPUT_DIR):
+    """新しい証明書を参照する既存の App Store 用プロファイルを再利用し、Bundle ID → パスを返す
+    
+    前回の実行がジャーナルのシークレットへの保存前に強制終了された場合でも、
+    作成済みのプロファイルを重複して作成しないようにする。
+    """
+    try:
+        profiles = api.get_profile_certificates_by_bundle_id(APP_STORE_PROFILE_TYPE)
+    except Exception as e:
+        print(f"警告: 作成済みのプロファイルの確認に失敗しました: {e}")
+        return {}
+    
+    adopted = {}
+    for bundle_id in bundle_ids:
+        profile_ids = [
+            profile_id for profile_id, certificate_ids in profiles.get(bundle_id, {}).items()
+            if certificate_id in certificate_ids
+        ]
+        if not profile_ids:
+            continue
+        try:
+            content = api.get_profile_content(profile_ids[0])
+        except Exception as e:
+            print(f"警告: 作成済みのプロファイルを取得できませんでした ({bundle_id}): {e}")
+            continue
+        path = os.path.join(profile_output_dir(bundle_id, output_root), profile_file_name(bundle_id))
+        with open(path, 'wb') as f:
+            f.write(content)
+        
+        journal.record_profile(bundle_id, profile_id=profile_ids[0], path=path)
+        print(f"新しい証明書で作成済みのプロファイルを再利用します: {bundle_id}")
+        adopted[bundle_id] = path
+    return adopted
+
+
+def parse_args():
+    """コマンドライン引数を解析（--retry-attempt を省略した場合は RETRY_ATTEMPT を使用）"""
+    parser = argparse.ArgumentParser(description='Update Apple Distribution certificate')
+    parser.add_argument('--retry-attempt', type=int, default=int(os.environ.get('RETRY_ATTEMPT', '0')),
+                        help='Retry attempt number (0 for the first run)')
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
+    
     # リトライ試行回数を取得
-    retry_attempt = int(os.environ.get('RETRY_ATTEMPT', '0'))
+    retry_attempt = args.retry_attempt
     if retry_attempt > 0:
         print(f"リトライ試行 {retry_attempt} 回目")
     
     # 証明書情報を読み込む
     cert_info = load_certificate_info()
     
-    # 古い証明書を無効化（オプション）
-    if cert_info.get('certificate_id'):
-        revoke_old_certificate(cert_info['certificate_id'])
-    
-    # 新しい証明書を作成
-    new_cert_info = create_new_certificate()
-    if not new_cert_info:
-        print("エラー: 証明書の作成に失敗しました")
-        sys.exit(1)
-    
     # Bundle IDを取得
     bundle_ids = json.loads(os.environ.get('BUNDLE_IDS', '[]'))
     if not bundle_ids:
@@ -218,28 +560,120 @@ def main():
         if bundle_id:
             bundle_ids = [bundle_id]
     
+    # リトライ時は前回の実行のジャーナルから再開（完了済みのステップは実行しない）
+    secret_name = journal_secret_name()
+    journal = RotationJournal.load(secret_name=secret_name) if retry_attempt > 0 else None
+    if journal is not None:
+        print("前回の実行のジャーナルから再開します")
+        bundle_ids = bundle_ids or journal.bundle_ids
+        
+        # アップロードまで完了している場合は何もしない
+        if journal.get('upload'):
+            print("\n✅ 前回の実行で証明書の更新とアップロードが完了しています")
+            if 'GITHUB_OUTPUT' in os.environ:
+                with open(os.environ['GITHUB_OUTPUT'], 'a') as f:
+                    f.write("success=true\n")
+                    f.write("uploaded=true\n")
+            return
+    
+    # USE_FASTLANE=true の場合は従来どおり Fastlane で証明書・プロファイルを作成
+    use_fastlane = os.environ.get('USE_FASTLANE', 'false').lower() == 'true'
+    api = None if use_fastlane else create_api_client()
+    
+    if journal is None:
+        journal = RotationJournal.start(cert_info.get('certificate_id'), bundle_ids, secret_name=secret_name)
+    
+    # 無効化で影響を受けるプロファイルを特定（無効化後は対応が取得できないため先に行う）
+    outgoing_certificate_id = journal.outgoing_certificate_id
+    plan = None
+    plan_entry = journal.get('plan')
+    if plan_entry is not None:
+        plan = plan_entry['targets'], plan_entry['unchanged'], plan_entry['profiles_to_delete']
+    elif bundle_ids and api is not None and outgoing_certificate_id and not FORCE_PROFILE_REGENERATION:
+        plan = plan_profile_rotation(api, bundle_ids, outgoing_certificate_id)
+        if plan is not None:
+            journal.record('plan', targets=plan[0], unchanged=plan[1], profiles_to_delete=plan[2])
+    
+    # 古い証明書を無効化（オプション）
+    if outgoing_certificate_id and not journal.get('revoke'):
+        if revoke_old_certificate(outgoing_certificate_id, api):
+            journal.record('revoke', certificate_id=outgoing_certificate_id)
+    
+    # 新しい証明書を作成（作成済みの場合は再利用）
+    create_entry = journal.get('create')
+    if create_entry is not None:
+        new_cert_info = restore_certificate(create_entry)
+    else:
+        new_cert_info = create_new_certificate(api)
+        if not new_cert_info:
+            print("エラー: 証明書の作成に失敗しました")
+            sys.exit(1)
+        record_certificate(journal, new_cert_info)
+    
     # 各Bundle IDのプロビジョニングプロファイルを更新
-    if bundle_ids:
-        for bundle_id in bundle_ids:
-            update_provisioning_profiles(bundle_id)
+    unchanged_bundle_ids = []
+    target_bundle_ids = bundle_ids
+    profiles_to_delete = None
+    if plan is not None:
+        # 無効化した証明書を参照しているプロファイルのみ再作成
+        target_bundle_ids, unchanged_bundle_ids, profiles_to_delete = plan
+    
+    # 作成済みのプロファイルは再利用し、残りのみ再作成
+    profile_paths = restore_profiles(journal, api, target_bundle_ids)
+    pending_bundle_ids = [b for b in target_bundle_ids if b not in profile_paths]
+    if pending_bundle_ids and api is not None and create_entry is not None:
+        # ジャーナルに記録される前に終了した場合も、作成済みのプロファイルは再利用
+        profile_paths.update(adopt_existing_profiles(
+            journal, api, pending_bundle_ids, new_cert_info['certificate_id']
+        ))
+        pending_bundle_ids = [b for b in pending_bundle_ids if b not in profile_paths]
+    try:
+        if pending_bundle_ids and api is not None:
+            # 1プロセス内で認証・接続を共有して一括で再作成
+            profile_paths.update(regenerate_profiles_via_api(
+                api, pending_bundle_ids, new_cert_info['certificate_id'],
+                profiles_to_delete=profiles_to_delete, journal=journal
+            ))
+        elif pending_bundle_ids:
+            profile_paths.update(run_profile_updates(
+                lambda bundle_id: update_provisioning_profiles(bundle_id, journal=journal),
+                pending_bundle_ids
+            ))
+    finally:
+        # プロファイルごとの記録はまとめてシークレットに保存（失敗時もリトライで再利用できるよう保存）
+        journal.flush()
+    profile_paths = {b: profile_paths[b] for b in target_bundle_ids if b in profile_paths}
     
     # 結果を保存
     result = {
         'success': True,
+        'certificate_id': new_cert_info.get('certificate_id'),
         'certificate_path': new_cert_info['certificate_path'],
         'p12_path': new_cert_info['p12_path'],
-        'bundle_ids': bundle_ids
+        'bundle_ids': bundle_ids,
+        'profile_paths': profile_paths,
+        # 再作成しなかった（既存のプロファイルをそのまま使う）Bundle ID
+        'unchanged_bundle_ids': unchanged_bundle_ids,
+        # 実行した外部コマンドの所要時間と終了ステータス
+        'commands': [command.to_dict() for command in command_history()]
     }
     
+    # P12 のパスワードはファイルに書き出さない（ステップの出力またはジャーナルから受け渡す）
     with open('/tmp/update_result.json', 'w') as f:
         json.dump(result, f, indent=2)
     
     # GitHub Actions の出力として設定
     if 'GITHUB_OUTPUT' in os.environ:
+        p12_password = new_cert_info.get('p12_password')
+        if p12_password:
+            # ログに出力されないようマスクしてから出力に設定
+            print(f"::add-mask::{p12_password}")
         with open(os.environ['GITHUB_OUTPUT'], 'a') as f:
             f.write(f"success=true\n")
             f.write(f"certificate_path={new_cert_info['certificate_path']}\n")
             f.write(f"p12_path={new_cert_info['p12_path']}\n")
+            if p12_password:
+                f.write(f"p12_password={p12_password}\n")
     
     print("\n✅ 証明書の更新が完了しました")
 
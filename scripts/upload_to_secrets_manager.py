@@ -5,10 +5,33 @@
 import os
 import sys
 import json
+import glob
 import base64
-import boto3
+import hashlib
+import threading
 from datetime import datetime
 from botocore.exceptions import ClientError
+from get_api_credentials import fetch_secret, get_secretsmanager_client
+from rotation_journal import RotationJournal, journal_secret_name
+
+
+# true の場合は内容に変更がなくてもシークレットを書き込む
+FORCE_SECRET_UPLOAD = os.environ.get('FORCE_SECRET_UPLOAD', 'false').lower() == 'true'
+
+# 存在を確認済みのシークレット名（update_secret だけで更新できる）
+_existing_secrets = set()
+_existing_secrets_lock = threading.Lock()
+
+
+def mark_secret_exists(secret_name):
+    """シークレットが存在することを記録"""
+    with _existing_secrets_lock:
+        _existing_secrets.add(secret_name)
+
+
+def secret_known_to_exist(secret_name):
+    with _existing_secrets_lock:
+        return secret_name in _existing_secrets
 
 
 def load_update_result():
@@ -28,39 +51,110 @@ def read_file_as_base64(file_path):
         return base64.b64encode(f.read()).decode('utf-8')
 
 
-def upload_to_secrets_manager(secret_data, secret_name, region_name):
-    """AWS Secrets Managerにシークレットをアップロード"""
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
+def load_existing_profiles(secret_name, region_name):
+    """既存のシークレットに保存されているプロビジョニングプロファイルを取得"""
+    try:
+        secret_data = fetch_secret(secret_name, region_name)
+    except ClientError as e:
+        print(f"警告: 既存のプロファイルを取得できませんでした: {e}", file=sys.stderr)
+        return {}
+    mark_secret_exists(secret_name)
+    return secret_data.get('provisioning_profiles', {})
+
+
+def sha256_of_base64(value):
+    """Base64 エンコードされた内容をデコードした SHA-256（16進数）"""
+    return hashlib.sha256(base64.b64decode(value)).hexdigest()
+
+
+def component_digests(certificate_data):
+    """証明書・P12・各プロビジョニングプロファイルの SHA-256"""
+    return {
+        'certificate': sha256_of_base64(certificate_data['certificate']),
+        'p12': sha256_of_base64(certificate_data['p12']),
+        'provisioning_profiles': {
+            bundle_id: sha256_of_base64(profile)
+            for bundle_id, profile in sorted(certificate_data.get('provisioning_profiles', {}).items())
+        }
+    }
+
+
+def load_stored_metadata(metadata_secret_name, region_name):
+    """前回アップロード時のメタデータ（ダイジェストを含む）を取得（なければ None）"""
+    try:
+        metadata = fetch_secret(metadata_secret_name, region_name)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceNotFoundException':
+            print(f"警告: メタデータを取得できませんでした（すべてアップロードします）: {e}", file=sys.stderr)
+        return None
+    mark_secret_exists(metadata_secret_name)
+    return metadata
+
+
+def changed_components(digests, bundle_ids, stored_metadata):
+    """前回のダイジェストと比較して、変更された要素の名前の一覧を返す"""
+    stored = (stored_metadata or {}).get('digests')
+    if not stored:
+        return ['certificate', 'p12'] + [f"provisioning_profiles/{b}" for b in digests['provisioning_profiles']]
     
+    changed = [name for name in ('certificate', 'p12') if digests[name] != stored.get(name)]
+    stored_profiles = stored.get('provisioning_profiles', {})
+    for bundle_id in sorted(set(digests['provisioning_profiles']) | set(stored_profiles)):
+        if digests['provisioning_profiles'].get(bundle_id) != stored_profiles.get(bundle_id):
+            changed.append(f"provisioning_profiles/{bundle_id}")
+    if bundle_ids != stored_metadata.get('bundle_ids'):
+        changed.append('bundle_ids')
+    return changed
+
+
+def _create_secret(client, secret_name, secret_string):
+    """シークレットを新規作成（既に存在する場合は False）"""
     try:
+        client.create_secret(Name=secret_name, SecretString=secret_string)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ResourceExistsException':
+            return False
+        raise
+    print(f"シークレット '{secret_name}' を作成しました")
+    return True
+
+
+def upload_to_secrets_manager(secret_data, secret_name, region_name, exists=None):
+    """AWS Secrets Managerにシークレットをアップロード
+    
+    exists が True（またはこの実行中に存在を確認済み）の場合は update_secret のみ、
+    False の場合は create_secret から実行する。None の場合は更新を試し、
+    存在しなければ作成する。
+    """
+    client = get_secretsmanager_client(region_name)
+    secret_string = json.dumps(secret_data)
+    if exists is None and secret_known_to_exist(secret_name):
+        exists = True
+    
+    try:
+        if exists is False and _create_secret(client, secret_name, secret_string):
+            mark_secret_exists(secret_name)
+            return True
+        
         # 既存のシークレットを更新
-        response = client.update_secret(
-            SecretId=secret_name,
-            SecretString=json.dumps(secret_data)
-        )
-        print(f"シークレット '{secret_name}' を更新しました")
+        try:
+            client.update_secret(SecretId=secret_name, SecretString=secret_string)
+            print(f"シークレット '{secret_name}' を更新しました")
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ResourceNotFoundException' or exists:
+                raise
+            # シークレットが存在しない場合は新規作成
+            if not _create_secret(client, secret_name, secret_string):
+                # 同時に作成された場合は更新し直す
+                client.update_secret(SecretId=secret_name, SecretString=secret_string)
+                print(f"シークレット '{secret_name}' を更新しました")
+        
+        mark_secret_exists(secret_name)
         return True
         
     except ClientError as e:
-        if e.response['Error']['Code'] == 'ResourceNotFoundException':
-            # シークレットが存在しない場合は新規作成
-            try:
-                response = client.create_secret(
-                    Name=secret_name,
-                    SecretString=json.dumps(secret_data)
-                )
-                print(f"シークレット '{secret_name}' を作成しました")
-                return True
-            except ClientError as create_error:
-                print(f"エラー: シークレットの作成に失敗しました: {create_error}", file=sys.stderr)
-                return False
-        else:
-            print(f"エラー: シークレットの更新に失敗しました: {e}", file=sys.stderr)
-            return False
+        print(f"エラー: シークレット '{secret_name}' のアップロードに失敗しました: {e}", file=sys.stderr)
+        return False
 
 
 def main():
@@ -91,54 +185,113 @@ def main():
     
     print("証明書ファイルを読み込んでいます...")
     
+    # P12 のパスワードは更新ステップの出力（P12_PASSWORD）から受け取り、
+    # ない場合（ローカル実行など）はジャーナルに記録されたものを使用
+    journal = RotationJournal.load(secret_name=journal_secret_name(environment), region_name=region_name)
+    p12_password = os.environ.get('P12_PASSWORD')
+    if not p12_password and journal is not None:
+        p12_password = (journal.get('create') or {}).get('p12_password')
+    
     # 証明書データを準備
     certificate_data = {
         'certificate': read_file_as_base64(cert_path),
         'p12': read_file_as_base64(p12_path),
-        'p12_password': os.environ.get('P12_PASSWORD', ''),  # Fastlaneが生成したパスワード
+        'p12_password': p12_password or '',
         'bundle_ids': update_result.get('bundle_ids', []),
         'updated_at': datetime.utcnow().isoformat(),
         'updated_by': 'github-actions'
     }
     
     # プロビジョニングプロファイルも含める（存在する場合）
-    profiles_dir = '/tmp/profiles'
-    if os.path.exists(profiles_dir):
-        profiles = {}
-        for profile_file in os.listdir(profiles_dir):
-            if profile_file.endswith('.mobileprovision'):
-                profile_path = os.path.join(profiles_dir, profile_file)
-                # Bundle IDをファイル名から推測（Fastlaneの命名規則に依存）
-                bundle_id = profile_file.replace('.mobileprovision', '').replace('_', '.')
+    profiles = {}
+    profile_paths = update_result.get('profile_paths')
+    if profile_paths:
+        # 更新スクリプトが記録した Bundle ID → プロファイルのパスを使用
+        for bundle_id, profile_path in profile_paths.items():
+            if os.path.exists(profile_path):
                 profiles[bundle_id] = read_file_as_base64(profile_path)
-        
-        if profiles:
-            certificate_data['provisioning_profiles'] = profiles
-            print(f"プロビジョニングプロファイル {len(profiles)} 個を含めます")
+    else:
+        # プロファイルは Bundle ID ごとのサブディレクトリに出力される
+        profiles_dir = '/tmp/profiles'
+        pattern = os.path.join(profiles_dir, '**', '*.mobileprovision')
+        for profile_path in sorted(glob.glob(pattern, recursive=True)):
+            parent = os.path.dirname(profile_path)
+            if parent != profiles_dir:
+                # サブディレクトリ名が Bundle ID
+                bundle_id = os.path.basename(parent)
+            else:
+                # Bundle IDをファイル名から推測（Fastlaneの命名規則に依存）
+                bundle_id = os.path.basename(profile_path).replace('.mobileprovision', '').replace('_', '.')
+            profiles[bundle_id] = read_file_as_base64(profile_path)
     
     # シークレット名を決定（環境別）
     secret_name = f"{secret_base_name}/distribution-certificate-{env_suffix}"
     
-    print(f"\nAWS Secrets Manager にアップロードしています...")
-    print(f"リージョン: {region_name}")
-    print(f"シークレット名: {secret_name}")
+    # 再作成しなかったプロファイルは既存のシークレットから引き継ぐ
+    # 引き継いだプロファイルは新しい証明書を参照していないため、メタデータに記録する
+    carried_over_bundle_ids = []
+    unchanged_bundle_ids = [b for b in update_result.get('unchanged_bundle_ids', []) if b not in profiles]
+    if unchanged_bundle_ids:
+        existing_profiles = load_existing_profiles(secret_name, region_name)
+        for bundle_id in unchanged_bundle_ids:
+            if bundle_id in existing_profiles:
+                profiles[bundle_id] = existing_profiles[bundle_id]
+                carried_over_bundle_ids.append(bundle_id)
+            else:
+                print(f"警告: 既存のシークレットに '{bundle_id}' のプロファイルがないため、引き継げません",
+                      file=sys.stderr)
+        if carried_over_bundle_ids:
+            print(f"変更のないプロビジョニングプロファイル {len(carried_over_bundle_ids)} 個を既存のシークレットから引き継ぎます")
+            print(f"警告: 引き継いだプロファイルは新しい証明書を含みません"
+                  f"（FORCE_PROFILE_REGENERATION=true で再作成できます）: {', '.join(carried_over_bundle_ids)}",
+                  file=sys.stderr)
+    
+    if profiles:
+        certificate_data['provisioning_profiles'] = profiles
+        print(f"プロビジョニングプロファイル {len(profiles)} 個を含めます")
+    
+    # 前回アップロードした内容と SHA-256 を比較（再実行時などは書き込みを省略）
+    metadata_secret_name = f"{secret_base_name}/certificate-metadata-{env_suffix}"
+    digests = component_digests(certificate_data)
+    changed = changed_components(
+        digests, certificate_data['bundle_ids'], load_stored_metadata(metadata_secret_name, region_name)
+    )
     
-    # アップロード
-    success = upload_to_secrets_manager(certificate_data, secret_name, region_name)
+    if not changed and not FORCE_SECRET_UPLOAD:
+        print("\n前回アップロードした内容と同一のため、シークレットの書き込みをスキップします")
+        success = True
+    else:
+        print(f"\n変更された要素: {', '.join(changed) if changed else '（なし、強制アップロード）'}")
+        
+        print(f"\nAWS Secrets Manager にアップロードしています...")
+        print(f"リージョン: {region_name}")
+        print(f"シークレット名: {secret_name}")
+        
+        success = upload_to_secrets_manager(certificate_data, secret_name, region_name)
+        
+        if success:
+            # メタデータも別途保存（オプション）。利用側はダイジェストで変更の有無を判定できる。
+            # ダイジェストは書き込んだ証明書の内容を表すため、証明書の書き込みが成功してから保存する
+            metadata = {
+                'last_update': datetime.utcnow().isoformat(),
+                'bundle_ids': update_result.get('bundle_ids', []),
+                'certificate_type': 'IOS_DISTRIBUTION',
+                'update_source': 'github-actions',
+                'digests': digests,
+                'changed_components': changed,
+                # 新しい証明書を参照していない（既存のものを引き継いだ）プロファイルの Bundle ID
+                'profile_certificate_mismatch': carried_over_bundle_ids
+            }
+            if not upload_to_secrets_manager(metadata, metadata_secret_name, region_name):
+                # 次回の実行では前回のダイジェストと一致しないため、再度書き込まれる
+                print("警告: メタデータのアップロードに失敗しました", file=sys.stderr)
     
     if success:
         print("\n✅ 証明書のアップロードが完了しました")
         
-        # メタデータも別途保存（オプション）
-        metadata = {
-            'last_update': datetime.utcnow().isoformat(),
-            'bundle_ids': update_result.get('bundle_ids', []),
-            'certificate_type': 'IOS_DISTRIBUTION',
-            'update_source': 'github-actions'
-        }
-        
-        metadata_secret_name = f"{secret_base_name}/certificate-metadata-{env_suffix}"
-        upload_to_secrets_manager(metadata, metadata_secret_name, region_name)
+        # ローテーションのジャーナルにアップロードの完了を記録
+        if journal is not None:
+            journal.record('upload', secret_name=secret_name, certificate_id=update_result.get('certificate_id'))
         
     else:
         print("\n❌ 証明書のアップロードに失敗しました")